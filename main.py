@@ -7,6 +7,7 @@ from google.appengine.ext.webapp import util
 from google.appengine.ext.webapp import template
 
 from suas import session, auth_handlers
+from suas.middleware import SessionMiddleware
 
 HOME_VIEW = template.Template("""
 <head><title>Home</title></head>
@@ -33,7 +34,7 @@ class HomeHandler(session.RequestHandler):
 
 ROUTES = [('/', HomeHandler)] + auth_handlers.ROUTES
 
-APP = webapp.WSGIApplication(ROUTES, debug=True)
+APP = SessionMiddleware(webapp.WSGIApplication(ROUTES, debug=True))
 
 def main():
 	util.run_wsgi_app(APP)
@@ -0,0 +1,204 @@
+#/usr/bin/env python2.5
+#-----------------------
+
+"""
+Non-blocking variants of the session loader, User.authenticate and
+login_required.
+
+The Python 2.5 runtime has no event loop, so these follow the App
+Engine RPC convention instead: each *_async function starts its work
+and returns at once with a future, whose get_result() waits for it.
+A handler can have the user fetch of its session, an authentication
+and its own Datastore calls in flight together, and wait for the
+slowest instead of the sum.
+
+Users are looked up through a backend, BACKEND by default:
+
+	get_user_async(nickname, cached=True)
+		return a future of the User with this nickname, or None;
+		cached=False bypasses USER_CACHE
+
+Password hashing runs on the pool set with passwords.set_hash_pool(),
+or on the worker that verifies the password if there is none.
+
+On App Engine the pools have no threads (see workers.threads_allowed),
+so a verification, and a fetch without db.get_async, run on the
+request thread when they are started: only db.get_async fetches are
+left in flight.
+
+	def post(self):
+		login = authenticate_async(nickname, password)
+		...	# other work
+		user = login.get_result()
+"""
+
+from threading import Lock
+
+from workers import WorkerPool, done
+import users
+from users import get_user, cached_user, cache_user, verify_password
+from session import SessionLoader, CookieSession
+from metrics import METRICS
+
+WORKERS = 8
+# the number of threads verifying passwords, and of the threads
+# fetching users when the user store has no get_user_rpc.
+
+
+class UserRPC(object):
+	"""Wrap the RPC of a user store's get_user_rpc, caching the user it returns."""
+	def __init__(self, rpc, nickname, cached):
+		self.rpc = rpc
+		self.nickname = nickname
+		self.cached = cached
+
+	def get_result(self):
+		user = self.rpc.get_result()
+		if user is not None and self.cached:
+			user = cache_user(user)
+		return user
+
+
+class DatastoreBackend(object):
+	"""
+	Fetch users with the RPC of users.USER_STORE.get_user_rpc where
+	it has one, e.g. db.get_async for the Datastore, and on a pool of
+	worker threads otherwise.  On App Engine the pool calls run inline.
+	"""
+	def __init__(self, workers=WORKERS):
+		self.workers = workers
+		self.pool = None
+		self.lock = Lock()
+
+	def get_user_async(self, nickname, cached=True):
+		if cached:
+			user = cached_user(nickname)
+			if user is not None:
+				return done(user)
+		store = users.user_store()
+		if hasattr(store, 'get_user_rpc'):
+			rpc = store.get_user_rpc(nickname)
+			if rpc is not None:
+				return UserRPC(rpc, nickname, cached)
+		if cached:
+			return self.get_pool().submit(get_user, nickname)
+		return self.get_pool().submit(store.get_user, nickname)
+
+	def get_pool(self):
+		self.lock.acquire()
+		try:
+			if self.pool is None:
+				self.pool = WorkerPool(self.workers)
+			return self.pool
+		finally:
+			self.lock.release()
+
+
+BACKEND = DatastoreBackend()
+
+_pool = None
+_pool_lock = Lock()
+
+def verify_pool():
+	# Kept apart from the backend's pool: a verification waits for a
+	# fetch, which must not be queued behind it.
+	global _pool
+	_pool_lock.acquire()
+	try:
+		if _pool is None:
+			_pool = WorkerPool(WORKERS)
+		return _pool
+	finally:
+		_pool_lock.release()
+
+
+def _verify(fetch, password):
+	t = METRICS.start()
+	try:
+		user = fetch.get_result()
+		if user and verify_password(user, password):
+			return user
+	finally:
+		METRICS.stop('users.authenticate', t)
+
+def authenticate_async(nickname, password, backend=None):
+	"""Return a future of User.authenticate(nickname, password)."""
+	fetch = (backend or BACKEND).get_user_async(nickname, cached=False)
+	return verify_pool().submit(_verify, fetch, password)
+
+
+class SessionUser(object):
+	"""The future user of a session, set on it by get_result()."""
+	def __init__(self, session, fetch):
+		self.session = session
+		self.fetch = fetch
+
+	def get_result(self):
+		user = self.fetch.get_result()
+		if self.session._nickname is not None:
+			self.session.user = user
+		return self.session.user
+
+def session_user_async(session, backend=None):
+	"""Return a future of session.user, fetched by backend."""
+	if session._nickname is None:
+		return done(session.user)
+	return SessionUser(session,
+		(backend or BACKEND).get_user_async(session._nickname))
+
+
+class AsyncSessionLoader(SessionLoader):
+	"""
+	A SessionLoader that opens the session as soon as it is created
+	and starts fetching its user, so that the fetch overlaps with the
+	work done before the user is needed.  Unlike SessionLoader, every
+	request pays for the fetch.
+
+		app = SessionMiddleware(app, loader_class=AsyncSessionLoader)
+
+	Attribute:
+		user_future		the future of session.user
+	"""
+	def __init__(self, environ, session_class=CookieSession, response=None,
+			backend=None, config=None):
+		SessionLoader.__init__(self, environ, session_class, response, config)
+		self.user_future = session_user_async(self.session, backend)
+
+def request_user_async(loader):
+	"""Return a future of the user of the session of loader."""
+	if isinstance(loader, AsyncSessionLoader):
+		return loader.user_future
+	return session_user_async(loader.session)
+
+
+def login_required_async(handler_method):
+	"""
+	A login_required for generator handler methods, which run up to
+	their first yield while the user is being fetched, and receive
+	the user from it:
+
+	>>> @login_required_async
+	... def get(self):
+	...     rpc = db.get_async(keys)	# in flight with the user fetch
+	...     user = yield
+	...     self.response.out.write('Hello, ' + user.nickname)
+
+	The code before the yield runs whether or not the user is logged
+	in, so it must not write the response or change any state.  If
+	the user is not logged in the generator is closed and we redirect
+	to the login page.
+	"""
+	def check_login(self, *args):
+		future = request_user_async(self.session_loader)
+		steps = handler_method(self, *args)
+		steps.next()
+		user = future.get_result()
+		if not user:
+			steps.close()
+			self.redirect('/login?' + 'redirect=' + self.request.url)
+			return
+		try:
+			steps.send(user)
+		except StopIteration:
+			pass
+	return check_login
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+#-----------------------
+
+"""
+Verify the session cookies found in access logs, in bulk.
+
+	python audit.py --secret 'Open, sesame!' access-*.jsonl
+	python audit.py --key 1='old secret' --key 2='new secret' < access.jsonl
+
+Logs are JSONL: one JSON object per request, with the 'Cookie' header
+under the field given by --cookie-field ('cookie' by default) and,
+optionally, the time of the request in seconds since the epoch under
+--time-field ('time').  Lines are read in chunks and verified by a pool
+of processes; at most --window chunks per process are in flight, so memory does
+not depend on the size of the logs.  Sessions per user, and users,
+are counted with fixed-size distinct-count sketches, and at most
+--max-users users are tracked: memory does not depend on the number
+of users either.
+
+Each request is classified as:
+	malformed	not a JSON object
+	no_session	no SID cookie
+	forged		a SID, user or atime cookie whose signature does not verify
+	expired		atime missing, or older than --session-ttl
+	valid
+
+Only valid sessions with a user are counted in the per-user stats.
+
+The statistics are written as JSON.  The process pool needs Python 2.6
+or later; with Python 2.5 the chunks are verified in-process.
+
+>>> configure('secret', {}, 'cookie', 'time', 604800)
+>>> from signedcookie import SignedCookie
+>>> c = SignedCookie('secret' + 'abc')
+>>> c['SID'] = 'abc'; c['user'] = 'foo'; c['atime'] = '1000'
+>>> header = '; '.join(m.output()[12:] for m in c.values())
+>>> line = json.dumps({'cookie': header, 'time': 2000})
+>>> counts, users = audit_lines([line, line.replace('foo', 'bar'), 'junk'])
+>>> sorted(counts.items())
+[('forged', 1), ('lines', 3), ('malformed', 1), ('valid', 1)]
+>>> users
+{'foo': [1, ['abc']]}
+>>> audit_lines([json.dumps({'cookie': u'pref=caf\xe9; SID=x'})])
+({'lines': 1, 'no_session': 1}, {})
+"""
+
+import sys
+from bisect import insort
+from hashlib import md5
+from optparse import OptionParser
+from time import time
+
+try:
+	import json
+except ImportError:
+	from django.utils import simplejson as json
+
+from signedcookie import SignedCookie, HMACSigner, KeyRing, BadSignatureError
+
+CHUNK_SIZE = 5000
+# the number of lines verified per task.
+
+WINDOW = 4
+# the number of chunks in flight per process.
+
+SKETCH_SIZE = 64
+# the number of hashes kept per user to count their sessions; counts
+# up to this size are exact, larger ones are estimates within ~15%.
+
+USERS_SKETCH_SIZE = 1024
+# the number of hashes kept to count users; estimates are within ~4%.
+
+MAX_USERS = 10000
+# the number of users whose sessions are tracked.  Past it, the half
+# with the fewest sessions is dropped, so the users reported are those
+# with the most sessions, approximately.
+
+_config = {}
+
+
+def configure(secret, keys, cookie_field, time_field, session_ttl):
+	"""Set the secrets and fields used by audit_lines() in this process."""
+	if keys:
+		ring = KeyRing(keys, current=sorted(keys)[-1], legacy=secret or None)
+		signer = ring.signer
+	else:
+		signer = lambda suffix='': HMACSigner(secret + suffix)
+	_config.update(signer=signer, cookie_field=cookie_field,
+		time_field=time_field, session_ttl=session_ttl)
+
+
+def audit_lines(lines):
+	"""
+	Return the counts of each class of request among lines, and a
+	dictionary mapping each user to [requests, distinct SIDs].
+	"""
+	signer = _config['signer']
+	cookie_field = _config['cookie_field']
+	time_field = _config['time_field']
+	session_ttl = _config['session_ttl']
+	now = time()
+	counts = {'lines': 0}
+	users = {}
+	for line in lines:
+		counts['lines'] += 1
+		try:
+			record = json.loads(line)
+			header = record.get(cookie_field) or ''
+		except (ValueError, AttributeError):
+			status = 'malformed'
+		else:
+			if isinstance(header, unicode):
+				header = header.encode('utf-8')
+			status, user, sid = classify(header, signer,
+				record.get(time_field, now), session_ttl)
+			if user:
+				u = users.setdefault(user, [0, set()])
+				u[0] += 1
+				u[1].add(sid)
+		counts[status] = counts.get(status, 0) + 1
+	for u in users.values():
+		u[1] = list(u[1])
+	return counts, users
+
+def classify(header, signer, when, session_ttl):
+	"""Return the class of a request, and its user and SID if valid."""
+	c = SignedCookie(signer())
+	c.load(header)
+	sid = c.peek('SID')
+	if sid is None:
+		return 'no_session', None, None
+	c.signer = signer(sid)
+	try:
+		c['SID']
+		user = ''
+		if c.peek('user') is not None:
+			user = c['user'].value
+		atime = int( c['atime'].value )
+	except BadSignatureError:
+		return 'forged', None, None
+	except (KeyError, ValueError):
+		return 'expired', None, None
+	try:
+		when = float(when)
+	except (TypeError, ValueError):
+		when = time()
+	if when - atime > session_ttl:
+		return 'expired', None, None
+	return 'valid', user, sid
+
+
+def sketch_add(sketch, item, size=SKETCH_SIZE):
+	"""Add an item to a sorted list of the size smallest item hashes."""
+	h = int( md5(item).hexdigest()[:15], 16 ) / float(16 ** 15)
+	if len(sketch) < size:
+		if h not in sketch:
+			insort(sketch, h)
+	elif h < sketch[-1] and h not in sketch:
+		insort(sketch, h)
+		sketch.pop()
+
+def sketch_count(sketch, size=SKETCH_SIZE):
+	if len(sketch) < size:
+		return len(sketch)
+	return int( (size - 1) / sketch[-1] )
+
+
+class Stats(object):
+	"""
+	The merged results of audit_lines().
+
+	>>> stats = Stats(max_users=2)
+	>>> stats.merge(({}, {'a': [1, ['1']], 'b': [1, ['2', '3']], 'c': [1, ['4']]}))
+	>>> sorted(stats.users), stats.report()['users']
+	(['b'], 3)
+	"""
+	def __init__(self, max_users=MAX_USERS):
+		self.counts = {}
+		self.users = {}		# user -> [requests, sketch]
+		self.users_sketch = []
+		self.max_users = max_users
+
+	def merge(self, result):
+		counts, users = result
+		for status, n in counts.items():
+			self.counts[status] = self.counts.get(status, 0) + n
+		for user, (requests, sids) in users.items():
+			u = self.users.setdefault(user, [0, []])
+			u[0] += requests
+			for sid in sids:
+				sketch_add(u[1], sid)
+			sketch_add(self.users_sketch, user, USERS_SKETCH_SIZE)
+		if len(self.users) > self.max_users:
+			self.prune()
+
+	def prune(self):
+		"""Drop the half of the users with the fewest sessions."""
+		users = [(sketch_count(sketch), requests, user)
+			for user, (requests, sketch) in self.users.items()]
+		users.sort()
+		for n, r, user in users[:len(users) - self.max_users // 2]:
+			del self.users[user]
+
+	def report(self, top=None):
+		users = [(sketch_count(sketch), requests, user)
+			for user, (requests, sketch) in self.users.items()]
+		users.sort(reverse=True)
+		if top:
+			users = users[:top]
+		return {'counts': self.counts,
+			'users': sketch_count(self.users_sketch, USERS_SKETCH_SIZE),
+			'sessions_per_user': [{'user': user, 'sessions': n, 'requests': r}
+				for n, r, user in users]}
+
+
+def chunks(files, size=CHUNK_SIZE):
+	chunk = []
+	for f in files:
+		for line in f:
+			chunk.append(line)
+			if len(chunk) == size:
+				yield chunk
+				chunk = []
+	if chunk:
+		yield chunk
+
+def run(files, config, processes=None, window=WINDOW, chunk_size=CHUNK_SIZE,
+		max_users=MAX_USERS):
+	"""Audit the lines of files, with a pool of processes; return a Stats."""
+	stats = Stats(max_users)
+	try:
+		from multiprocessing import Pool, cpu_count
+	except ImportError:
+		configure(*config)
+		for chunk in chunks(files, chunk_size):
+			stats.merge(audit_lines(chunk))
+		return stats
+	processes = processes or cpu_count()
+	pool = Pool(processes, configure, config)
+	pending = []
+	try:
+		for chunk in chunks(files, chunk_size):
+			pending.append( pool.apply_async(audit_lines, (chunk,)) )
+			if len(pending) >= processes * window:
+				stats.merge(pending.pop(0).get())
+		for result in pending:
+			stats.merge(result.get())
+	finally:
+		pool.terminate()
+	return stats
+
+
+def main():
+	parser = OptionParser(usage='%prog [options] [log.jsonl ...]')
+	parser.add_option('--secret', default='',
+		help='the secret key (session.SECRET_KEY), or the legacy one with --key')
+	parser.add_option('--key', action='append', default=[], metavar='ID=SECRET',
+		help='a key of the key ring; may be repeated')
+	parser.add_option('--cookie-field', default='cookie')
+	parser.add_option('--time-field', default='time')
+	parser.add_option('--session-ttl', type='int', default=604800)
+	parser.add_option('--processes', type='int', help='default: one per CPU')
+	parser.add_option('--chunk-size', type='int', default=CHUNK_SIZE)
+	parser.add_option('--window', type='int', default=WINDOW,
+		help='the number of chunks in flight per process')
+	parser.add_option('--top', type='int', default=100,
+		help='the number of users reported, by sessions (0 for all tracked)')
+	parser.add_option('--max-users', type='int', default=MAX_USERS,
+		help='the number of users whose sessions are tracked')
+	options, paths = parser.parse_args()
+	keys = dict(k.split('=', 1) for k in options.key)
+	if not options.secret and not keys:
+		parser.error('give --secret or --key')
+	files = [open(path) for path in paths] or [sys.stdin]
+	config = (options.secret, keys, options.cookie_field, options.time_field,
+		options.session_ttl)
+	stats = run(files, config, options.processes, options.window, options.chunk_size,
+		options.max_users)
+	json.dump(stats.report(options.top), sys.stdout, indent=2, sort_keys=True)
+	sys.stdout.write('\n')
+
+if __name__ == '__main__':
+	main()
@@ -11,7 +11,19 @@ Utility method: login_required -- for use as a decorator.
 from google.appengine.ext.webapp import template
 
 from session import RequestHandler
-from users import User, UserSignup, salt_n_hash, signup_id
+from users import authenticate, get_user, create_signup, confirm_signup, signup_owner
+from nicknames import NICKNAMES, nickname_available, CheckNickname, CHECK_URL
+from throttle import LoginThrottle
+from mailqueue import TaskQueueMail, MailWorker, MAIL_WORKER_URL
+from sweeper import SweepSignups, SweepExpired, SWEEP_URL, EXPIRED_SWEEP_URL
+from metrics import StatsHandler, STATS_URL
+
+LOGIN_THROTTLE = LoginThrottle()
+# Limits login attempts per nickname and client address on this instance;
+# see LOGIN_THROTTLE.stats() for the rejected volume.
+
+MAIL_QUEUE = TaskQueueMail()
+# Confirmation mails are queued here and sent by MailWorker.
 
 # Adapt to use your app's view.
 SIGNUP_VIEW = template.Template("""
@@ -44,7 +56,21 @@ LOGIN_VIEW = template.Template("""
 </body>
 """)
 
-class Signup(RequestHandler):
+class MailingHandler(RequestHandler):
+	"""
+	A RequestHandler which flushes MAIL_QUEUE once, after its response
+	is written; handlers only send() their mails.
+	"""
+	def initialize(self, request, response):
+		super(MailingHandler, self).initialize(request, response)
+		wsgi_write = response.wsgi_write
+		def write_and_flush(start_response):
+			wsgi_write(start_response)
+			MAIL_QUEUE.flush()
+		response.wsgi_write = write_and_flush
+
+
+class Signup(MailingHandler):
 	def get(self):
 		ctx = template.Context({"session": self.session})
 		self.response.out.write(SIGNUP_VIEW.render(ctx))
@@ -59,27 +85,23 @@ class Signup(RequestHandler):
 			self.session[ 'flash_msg' ] = '<p>Password fields did not match.</p>'
 			self.redirect('/signup')
 			return
-		user = User.get_or_insert(nickname=nickname,
-					email=email,
-					pwd=salt_n_hash(password),
-					key_name=nickname)
 		self.session.start(None)
-		if not User.authenticate(nickname, password):
+		id = None
+		if nickname_available(nickname) or self.resignup(nickname):
+			id = create_signup(nickname, email, password)
+		if id is None:
 			self.session[ 'flash_msg' ] = '<p>Sorry, the nickname you chose is already taken.</p>'
 			self.redirect(self.request.url)
 			return
-		id = signup_id(nickname)
-		signup = UserSignup(user=user, key_name=id)
-		signup.put()
-		confirm_url = self.request.relative_url('confirmsignup?id='+id)
-		from google.appengine.api import mail
+		NICKNAMES.add(nickname)
+		confirm_url = self.request.relative_url('confirmsignup?id=' + id)
 		sender = 'Registrar <registrar@app-id.appspotmail.com>'
 		subject = 'Confirm your registration'
 		body = \
 			'Hello %s,\n\n' % nickname + \
 			'To confirm your registration, please visit the link below:\n\n' + \
 			'<%s>\n' % confirm_url
-		mail.send_mail( sender, email, subject, body )
+		MAIL_QUEUE.send( sender, email, subject, body )
 		self.session['flash_msg'] = \
 			'<p>Thank you for signing up, %s! A confirmation ' % nickname + \
 			'message is on its way to your email inbox. It will contain a link ' + \
@@ -87,18 +109,27 @@ class Signup(RequestHandler):
 			'<p>See you soon!</p>'
 		self.redirect('/')
 
+	def resignup(self, nickname):
+		# a suspended user may sign up again; only then is the password
+		# hashed to find out whether the nickname is really taken.
+		user = get_user(nickname)
+		return user is None or user.suspended
+
 
 class ConfirmSignup(RequestHandler):
 	def get(self):
 		id = self.request.get('id')
-		signup = UserSignup.get_by_key_name(id)
-		if not signup:
+		user = confirm_signup(id)
+		if not user:
+			owner = signup_owner(id)
+			if owner and not owner.suspended:
+				# the link was followed twice
+				self.session['flash_msg'] = '<p>Your account is already confirmed. Please log in.</p>'
+				self.redirect('/login')
+				return
 			self.error(401)
 			return
-		user = signup.user
-		user.suspended = False
-		user.put()
-		signup.delete()
+		NICKNAMES.add(user.nickname)
 		self.session.start(user)
 		self.session['flash_msg'] = '<p>Your account has been confirmed.</p>'
 		self.redirect('/user/' + user.nickname)
@@ -111,8 +142,16 @@ class Login(RequestHandler):
 		self.response.out.write(LOGIN_VIEW.render(ctx))
 	
 	def post(self):
-		user = User.authenticate(self.request.get('nickname'), self.request.get('password'))
+		nickname = self.request.get('nickname')
+		address = self.request.remote_addr
+		if not LOGIN_THROTTLE.allow(nickname, address):
+			self.session.start( None )
+			self.session['flash_msg'] = '<p>Too many login attempts. Please try again later.</p>'
+			self.redirect(self.request.url)
+			return
+		user = authenticate(nickname, self.request.get('password'))
 		if user and not user.suspended:
+			LOGIN_THROTTLE.reset(nickname, address)
 			self.session.start(user)
 			redirect = self.request.get('redirect')
 			self.redirect(redirect)
@@ -141,20 +180,38 @@ def login_required(handler_method):
 
 
 class Logout(RequestHandler):
+	"""
+	Handle /logout, or /logout?everywhere=1 to end all the sessions of
+	the user.  If the session's config has revocations (e.g. with
+	session.REVOCATIONS set), the SID is revoked so that a copy of the
+	cookies cannot be used any more.
+	"""
 	def get(self):
 		if not self.session.user:
 			self.error(404)
 			return
 		nickname = self.session.user.nickname
+		revocations = self.session.config.revocations
+		if revocations is not None:
+			if self.request.get('everywhere') == '1':
+				revocations.revoke_user(nickname)
+			else:
+				revocations.revoke_session(self.session['SID'])
 		self.session.start(None)
+		self.session.regen()
 		self.session['flash_msg'] = '<p>Goodbye, %s!</p>' % nickname
 		self.redirect('/login')
 
 # Add this to your app's routes.
 ROUTES = [
 	('/signup', Signup),
+	(CHECK_URL, CheckNickname),
 	('/confirmsignup', ConfirmSignup),
 	('/login', Login),
-	('/logout', Logout)
+	('/logout', Logout),
+	(MAIL_WORKER_URL, MailWorker),
+	(SWEEP_URL, SweepSignups),
+	(EXPIRED_SWEEP_URL, SweepExpired),
+	(STATS_URL, StatsHandler)
 ]
 
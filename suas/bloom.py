@@ -0,0 +1,69 @@
+#/usr/bin/env python2.5
+#-----------------------
+
+"""
+A Bloom filter: a fixed-size set of strings answering membership
+queries with no false negatives, and false positives at about the
+error rate it was sized for, as long as it holds at most capacity
+strings.
+
+>>> f = BloomFilter(capacity=1000, error_rate=0.01)
+>>> f.add('foo'); f.add('foo')
+>>> 'foo' in f, 'bar' in f
+(True, False)
+>>> len(f), f.size
+(1, 1199)
+"""
+
+from array import array
+from hashlib import md5
+from math import ceil, log
+from struct import unpack
+
+
+class BloomFilter(object):
+	"""
+	Attributes:
+		capacity	the number of strings it was sized for
+		size		its size in bytes
+	"""
+	def __init__(self, capacity=100000, error_rate=0.001):
+		self.capacity = capacity
+		self.nbits = int( ceil(-capacity * log(error_rate) / log(2) ** 2) )
+		self.nhashes = max(1, int( round(self.nbits * log(2) / capacity) ))
+		self.size = (self.nbits + 7) // 8
+		self.bits = array('B', [0]) * self.size
+		self.count = 0
+
+	def positions(self, key):
+		# double hashing: the i-th position is h1 + i * h2
+		if isinstance(key, unicode):
+			key = key.encode('utf-8')
+		h1, h2 = unpack('<QQ', md5(key).digest())
+		nbits = self.nbits
+		return [ (h1 + i * h2) % nbits for i in range(self.nhashes) ]
+
+	def add(self, key):
+		bits = self.bits
+		new = False
+		for p in self.positions(key):
+			mask = 1 << (p & 7)
+			if not bits[p >> 3] & mask:
+				bits[p >> 3] |= mask
+				new = True
+		if new:
+			self.count += 1
+
+	def __contains__(self, key):
+		bits = self.bits
+		for p in self.positions(key):
+			if not bits[p >> 3] & (1 << (p & 7)):
+				return False
+		return True
+
+	def __len__(self):
+		"""
+		Return the number of distinct strings added, give or take the
+		false positives: a string whose bits were all set is not counted.
+		"""
+		return self.count
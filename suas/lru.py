@@ -0,0 +1,142 @@
+#/usr/bin/env python2.5
+#-----------------------
+
+"""
+A bounded, thread-safe LRU cache with an optional time-to-live.
+
+Entries are kept in a dictionary for O(1) lookup and threaded on a
+circular doubly-linked list for O(1) recency updates and eviction.
+Once the cache holds maxsize entries, inserting a new key evicts the
+least recently used one.  If ttl is given, entries older than ttl
+seconds are treated as missing and dropped on access.
+
+>>> c = LRUCache(maxsize=2)
+>>> c['a'] = 1
+>>> c['b'] = 2
+>>> c.get('a')
+1
+>>> c['c'] = 3
+>>> c.get('b') is None
+True
+>>> c.hits, c.misses
+(1, 1)
+"""
+
+from threading import Lock
+from time import time
+
+# indices into a link: [PREV, NEXT, KEY, VALUE, EXPIRES]
+PREV, NEXT, KEY, VALUE, EXPIRES = 0, 1, 2, 3, 4
+
+
+class LRUCache(object):
+	"""
+	Attributes:
+		maxsize		the maximum number of entries
+		ttl			the lifetime of an entry in seconds, or None
+		hits		the number of successful lookups
+		misses		the number of failed or expired lookups
+		evictions	the number of entries dropped to make room
+	"""
+	def __init__(self, maxsize=1024, ttl=None, clock=time):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.clock = clock
+		self.lock = Lock()
+		self.clear()
+
+	def clear(self):
+		"""Drop all entries and reset the counters."""
+		self.lock.acquire()
+		try:
+			self.__map = {}
+			self.__root = root = []
+			root[:] = [root, root, None, None, None]
+			self.hits = self.misses = self.evictions = 0
+		finally:
+			self.lock.release()
+
+	def __len__(self):
+		return len(self.__map)
+
+	def __contains__(self, key):
+		return self.get(key, self) is not self
+
+	def __unlink(self, link):
+		link[PREV][NEXT] = link[NEXT]
+		link[NEXT][PREV] = link[PREV]
+
+	def __link_front(self, link):
+		root = self.__root
+		last = root[PREV]
+		link[PREV], link[NEXT] = last, root
+		last[NEXT] = root[PREV] = link
+
+	def get(self, key, default=None):
+		"""Return the value for key, marking it most recently used."""
+		self.lock.acquire()
+		try:
+			link = self.__map.get(key)
+			if link is None:
+				self.misses += 1
+				return default
+			if link[EXPIRES] is not None and link[EXPIRES] <= self.clock():
+				self.__unlink(link)
+				del self.__map[key]
+				self.misses += 1
+				return default
+			self.__unlink(link)
+			self.__link_front(link)
+			self.hits += 1
+			return link[VALUE]
+		finally:
+			self.lock.release()
+
+	def __getitem__(self, key):
+		value = self.get(key, self)
+		if value is self:
+			raise KeyError(key)
+		return value
+
+	def __setitem__(self, key, value):
+		if self.ttl is None:
+			expires = None
+		else:
+			expires = self.clock() + self.ttl
+		self.lock.acquire()
+		try:
+			link = self.__map.get(key)
+			if link is not None:
+				self.__unlink(link)
+				link[VALUE], link[EXPIRES] = value, expires
+			else:
+				if len(self.__map) >= self.maxsize:
+					oldest = self.__root[NEXT]
+					self.__unlink(oldest)
+					del self.__map[oldest[KEY]]
+					self.evictions += 1
+				link = [None, None, key, value, expires]
+				self.__map[key] = link
+			self.__link_front(link)
+		finally:
+			self.lock.release()
+
+	def pop(self, key, default=None):
+		"""Remove key and return its value, or default if absent."""
+		self.lock.acquire()
+		try:
+			link = self.__map.pop(key, None)
+			if link is None:
+				return default
+			self.__unlink(link)
+			return link[VALUE]
+		finally:
+			self.lock.release()
+
+	invalidate = pop
+
+	def stats(self):
+		"""Return a dictionary of the cache counters."""
+		return {'size': len(self.__map), 'maxsize': self.maxsize,
+			'hits': self.hits, 'misses': self.misses,
+			'evictions': self.evictions}
@@ -0,0 +1,179 @@
+#/usr/bin/env python2.5
+#-----------------------
+
+"""
+Queued delivery of the mails sent by the auth handlers, so that
+sending them is off the request's critical path.
+
+A mail queue collects messages with send() and hands them over in
+batches of up to batch_size with flush().  The queue is shared by the
+requests of an instance, and handlers do not flush it themselves:
+auth_handlers.MailingHandler flushes it once at the end of a request,
+after its response is written, so a batch holds the mails of that
+request and of those queued meanwhile by concurrent ones.  Batches
+whose delivery fails go back on the queue for the next flush.
+	* TaskQueueMail enqueues one task per batch; MailWorker, mounted
+	at MAIL_WORKER_URL, sends the messages of a task.
+	* LocalMailQueue delivers batches in-process, by default into its
+	sent attribute, which makes it a stand-in for tests.
+
+>>> q = LocalMailQueue(batch_size=2)
+>>> for to in ('a@x.org', 'b@x.org', 'c@x.org'):
+...     q.send('me@x.org', to, 'Hi', 'Hello')
+>>> q.flush()
+>>> [len(batch) for batch in q.batches]
+[2, 1]
+
+>>> def down(batch):
+...     raise IOError('mail service down')
+>>> q = LocalMailQueue(send_batch=down)
+>>> q.send('me@x.org', 'a@x.org', 'Hi', 'Hello')
+>>> q.flush()
+Traceback (most recent call last):
+IOError: mail service down
+>>> len(q.pending)
+1
+"""
+
+import logging
+from threading import Lock
+
+from google.appengine.ext import webapp
+
+try:
+	import json
+except ImportError:
+	from django.utils import simplejson as json
+
+MAIL_WORKER_URL = '/_suas/mail'
+MAIL_QUEUE_NAME = 'default'
+BATCH_SIZE = 50
+
+
+class MailQueue(object):
+	"""
+	Base class of mail queues; subclasses implement deliver(batch),
+	where batch is a list of (sender, to, subject, body) tuples.
+	"""
+	def __init__(self, batch_size=BATCH_SIZE):
+		self.batch_size = batch_size
+		self.pending = []
+		self.lock = Lock()
+
+	def send(self, sender, to, subject, body):
+		"""Queue a message until the next flush()."""
+		self.lock.acquire()
+		try:
+			self.pending.append( (sender, to, subject, body) )
+		finally:
+			self.lock.release()
+
+	def flush(self):
+		"""
+		Deliver the queued messages in batches, all started before
+		waiting for any of them.  The batches which fail are queued
+		again, and the first error is raised once all are done.
+		"""
+		self.lock.acquire()
+		try:
+			pending, self.pending = self.pending, []
+		finally:
+			self.lock.release()
+		started, failed, error = [], [], None
+		for i in range(0, len(pending), self.batch_size):
+			batch = pending[i:i + self.batch_size]
+			try:
+				started.append( (batch, self.deliver(batch)) )
+			except Exception, e:
+				failed.append(batch)
+				error = error or e
+		for batch, rpc in started:
+			try:
+				if rpc is not None:
+					rpc.get_result()
+			except Exception, e:
+				failed.append(batch)
+				error = error or e
+		if failed:
+			self.lock.acquire()
+			try:
+				self.pending[:0] = [m for batch in failed for m in batch]
+			finally:
+				self.lock.release()
+			raise error
+
+	def deliver(self, batch):
+		"""Deliver a batch; return an RPC to wait for, or None if done."""
+		raise NotImplementedError
+
+
+class LocalMailQueue(MailQueue):
+	"""
+	Deliver batches in-process with send_batch(batch), or record
+	them in the batches attribute if send_batch is None.
+	"""
+	def __init__(self, batch_size=BATCH_SIZE, send_batch=None):
+		MailQueue.__init__(self, batch_size)
+		self.send_batch = send_batch
+		self.batches = []
+
+	def deliver(self, batch):
+		if self.send_batch is None:
+			self.batches.append(batch)
+		else:
+			self.send_batch(batch)
+
+	def sent(self):
+		"""Return all the messages delivered so far."""
+		return [m for batch in self.batches for m in batch]
+
+
+class TaskQueueMail(MailQueue):
+	"""Deliver each batch as a task handled by MailWorker."""
+	def __init__(self, batch_size=BATCH_SIZE, queue_name=MAIL_QUEUE_NAME,
+			url=MAIL_WORKER_URL):
+		MailQueue.__init__(self, batch_size)
+		self.queue_name = queue_name
+		self.url = url
+
+	def deliver(self, batch):
+		try:
+			from google.appengine.api import taskqueue
+		except ImportError:
+			from google.appengine.api.labs import taskqueue
+		task = taskqueue.Task(url=self.url, payload=json.dumps(batch))
+		queue = taskqueue.Queue(self.queue_name)
+		if hasattr(queue, 'add_async'):
+			return queue.add_async(task)
+		queue.add(task)
+
+
+def send_batch(batch):
+	"""Send a batch of messages with the App Engine mail API."""
+	from google.appengine.api import mail
+	for sender, to, subject, body in batch:
+		mail.send_mail(sender, to, subject, body)
+
+
+class MailWorker(webapp.RequestHandler):
+	"""
+	Send the batch of messages posted by TaskQueueMail.  If a message
+	fails, the task is retried only if none was sent; otherwise the
+	unsent ones are enqueued as a new task, so that none is sent twice.
+	"""
+	def post(self):
+		batch = json.loads(self.request.body)
+		for i in range(len(batch)):
+			try:
+				send_batch(batch[i:i + 1])
+			except Exception:
+				if i == 0:
+					raise
+				logging.exception('Mail %d of %d failed; requeuing the rest',
+					i + 1, len(batch))
+				queue_name = self.request.headers.get('X-AppEngine-QueueName',
+					MAIL_QUEUE_NAME)
+				rpc = TaskQueueMail(queue_name=queue_name).deliver(batch[i:])
+				if rpc is not None:
+					rpc.get_result()
+				return
@@ -0,0 +1,176 @@
+#/usr/bin/env python2.5
+#-----------------------
+
+"""
+Timers and counters for the session and authentication phases.
+
+Collection is off until a sink is installed with set_sink(); until
+then METRICS.start() returns None and every other call returns at
+once.  Sinks implement:
+
+	incr(name, n)			add n to a counter
+	timing(name, seconds)	record the duration of a phase
+	end_request(path)		called once the response is written
+
+Provided sinks:
+	MemorySink	aggregates per instance; served as JSON by StatsHandler
+	LogSink		logs one line per request
+
+Names used by suas:
+	session.load, session.user_fetch, session.regen, users.authenticate
+		(timings)
+	session.no_sid, session.bad_signature, cookie.bad_signature,
+	session.expired, session.revoked, session.regen, session.touch,
+	nicknames.definite_miss
+		(counters)
+
+>>> sink = MemorySink()
+>>> set_sink(sink)
+>>> t = METRICS.start(); METRICS.stop('phase', t); METRICS.incr('event')
+>>> sink.snapshot()['counters']
+{'event': 1}
+>>> set_sink(None)
+"""
+
+import logging
+from threading import Lock, local
+from time import time
+
+try:
+	from google.appengine.ext.webapp import RequestHandler
+except ImportError:
+	# off App Engine, e.g. with a SQLiteUserStore; StatsHandler needs the SDK
+	RequestHandler = object
+
+try:
+	import json
+except ImportError:
+	from django.utils import simplejson as json
+
+STATS_URL = '/_suas/stats'
+
+
+class Metrics(object):
+	def __init__(self, sink=None):
+		self.sink = sink
+
+	def incr(self, name, n=1):
+		if self.sink is not None:
+			self.sink.incr(name, n)
+
+	def start(self):
+		"""Return a start time for stop(), or None if disabled."""
+		if self.sink is not None:
+			return time()
+
+	def stop(self, name, start):
+		if start is not None and self.sink is not None:
+			self.sink.timing(name, time() - start)
+
+	def end_request(self, path):
+		if self.sink is not None:
+			self.sink.end_request(path)
+
+
+METRICS = Metrics()
+
+def set_sink(sink):
+	"""Send metrics to sink, or stop collecting if sink is None."""
+	METRICS.sink = sink
+
+
+class MemorySink(object):
+	"""
+	Aggregate counters, and the count, total and maximum of each
+	timing, since creation or the last reset().
+	"""
+	def __init__(self):
+		self.lock = Lock()
+		self.reset()
+
+	def reset(self):
+		self.lock.acquire()
+		try:
+			self.counters = {}
+			self.timings = {}	# name -> [count, total, max]
+			self.requests = 0
+		finally:
+			self.lock.release()
+
+	def incr(self, name, n):
+		self.lock.acquire()
+		try:
+			self.counters[name] = self.counters.get(name, 0) + n
+		finally:
+			self.lock.release()
+
+	def timing(self, name, seconds):
+		self.lock.acquire()
+		try:
+			t = self.timings.get(name)
+			if t is None:
+				self.timings[name] = [1, seconds, seconds]
+			else:
+				t[0] += 1
+				t[1] += seconds
+				t[2] = max(t[2], seconds)
+		finally:
+			self.lock.release()
+
+	def end_request(self, path):
+		self.lock.acquire()
+		try:
+			self.requests += 1
+		finally:
+			self.lock.release()
+
+	def snapshot(self):
+		"""Return the aggregates as a dictionary, times in milliseconds."""
+		self.lock.acquire()
+		try:
+			timings = {}
+			for name, (count, total, longest) in self.timings.items():
+				timings[name] = {'count': count,
+					'mean_ms': round(total * 1000 / count, 3),
+					'max_ms': round(longest * 1000, 3)}
+			return {'requests': self.requests,
+				'counters': dict(self.counters), 'timings': timings}
+		finally:
+			self.lock.release()
+
+
+class LogSink(object):
+	"""Log the metrics of each request on one line."""
+	def __init__(self, level=logging.INFO):
+		self.level = level
+		self.current = local()
+
+	def events(self):
+		try:
+			return self.current.events
+		except AttributeError:
+			self.current.events = []
+			return self.current.events
+
+	def incr(self, name, n):
+		self.events().append('%s=%d' % (name, n))
+
+	def timing(self, name, seconds):
+		self.events().append('%s=%.2fms' % (name, seconds * 1000))
+
+	def end_request(self, path):
+		events = self.events()
+		if events:
+			logging.log(self.level, 'suas %s %s', path, ' '.join(events))
+		self.current.events = []
+
+
+class StatsHandler(RequestHandler):
+	"""Serve the aggregates of the installed MemorySink as JSON."""
+	def get(self):
+		sink = METRICS.sink
+		if not isinstance(sink, MemorySink):
+			self.error(404)
+			return
+		self.response.headers['Content-Type'] = 'application/json'
+		self.response.out.write(json.dumps(sink.snapshot(), sort_keys=True))
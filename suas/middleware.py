@@ -0,0 +1,58 @@
+#/usr/bin/env python2.5
+#-----------------------
+
+"""
+WSGI middleware providing the session to any WSGI application.
+
+SessionMiddleware puts a session.SessionLoader in the environ under
+session.ENVIRON_KEY.  The session is opened on first access through
+get_session(environ), or self.session in a session.RequestHandler, and
+its 'Set-Cookie' headers are added when the application calls
+start_response.
+
+	app = SessionMiddleware(webapp.WSGIApplication(ROUTES))
+
+Each application, or tenant, may have its own session.SessionConfig:
+
+	app = SessionMiddleware(app, config=SessionConfig(secret, tenant='acme'))
+
+	def hello(environ, start_response):
+		user = get_session(environ).user
+		...
+"""
+
+from session import SessionLoader, CookieSession, ENVIRON_KEY
+
+
+class SessionMiddleware(object):
+	"""
+	loader_class is called with the environ, session_class and config;
+	it is SessionLoader or a subclass, e.g. asyncauth.AsyncSessionLoader.
+
+	config is a SessionConfig, None for session.DEFAULT_CONFIG, or a
+	function returning either for the environ of a request, e.g. to pick
+	the config of a tenant by host name.
+	"""
+	def __init__(self, app, session_class=CookieSession, loader_class=SessionLoader,
+			config=None):
+		self.app = app
+		self.session_class = session_class
+		self.loader_class = loader_class
+		self.config = config
+
+	def __call__(self, environ, start_response):
+		config = self.config
+		if callable(config):
+			config = config(environ)
+		loader = self.loader_class(environ, self.session_class, config=config)
+		environ[ENVIRON_KEY] = loader
+		def session_start_response(status, headers, exc_info=None):
+			headers = list(headers)
+			headers.extend( ('Set-Cookie', value) for value in loader.headers() )
+			return start_response(status, headers, exc_info)
+		return self.app(environ, session_start_response)
+
+
+def get_session(environ):
+	"""Return the session of the request, opening it if needed."""
+	return environ[ENVIRON_KEY].session
@@ -0,0 +1,147 @@
+#/usr/bin/env python2.5
+#-----------------------
+
+"""
+Nickname availability checks that do not touch the storage for
+nicknames that are definitely free.
+
+NicknameIndex keeps a Bloom filter of the existing nicknames.  It is
+built by scanning users.USER_STORE one batch per check; until the
+first scan completes, every check goes to the storage.  The signup
+handlers add() each nickname they take or confirm at once, and the
+filter is scanned again RESCAN_INTERVAL after each scan, or when it
+grows past its capacity, to pick up the nicknames taken on other
+instances.  A rescan fills a new filter while the current one keeps
+answering.
+
+A nickname missing from the filter is free, unless it was taken on
+another instance since the last scan; create_signup stays the
+authority, so that only means the signup form finds out later.  A
+nickname in the filter is looked up with users.get_user, to rule out
+false positives and users swept since they were added.
+
+CheckNickname, mounted at CHECK_URL, answers with JSON for live
+form validation:
+
+	GET /signup/check?nickname=foo  ->  {"available": false, "nickname": "foo"}
+"""
+
+from threading import Lock
+from time import time
+
+from google.appengine.ext import webapp
+
+try:
+	import json
+except ImportError:
+	from django.utils import simplejson as json
+
+import users
+from users import get_user
+from bloom import BloomFilter
+from metrics import METRICS
+
+CHECK_URL = '/signup/check'
+
+NICKNAME_CAPACITY = 100000
+NICKNAME_ERROR_RATE = 0.01
+# the minimum size of the filter; past its capacity it is scanned
+# again, sized for twice the number of nicknames it holds.
+
+SCAN_BATCH_SIZE = 1000
+# the number of nicknames read per check while scanning.
+
+RESCAN_INTERVAL = 600  # 600s = 10m
+# the interval between the end of a scan and the start of the next.
+
+
+class NicknameIndex(object):
+	"""
+	Attributes:
+		current		the filter of the last complete scan, kept up to
+					date by add(), or None
+		building	the filter of the scan in progress, or None
+	"""
+	def __init__(self, capacity=NICKNAME_CAPACITY, error_rate=NICKNAME_ERROR_RATE,
+			batch_size=SCAN_BATCH_SIZE, rescan_interval=RESCAN_INTERVAL, clock=time):
+		self.capacity = capacity
+		self.error_rate = error_rate
+		self.batch_size = batch_size
+		self.rescan_interval = rescan_interval
+		self.clock = clock
+		self.lock = Lock()
+		self.current = self.building = None
+		self.cursor = None
+		self.scanning = False
+		self.next_scan = 0
+
+	def step(self):
+		"""Scan the next batch of nicknames, if a scan is due or in progress."""
+		self.lock.acquire()
+		try:
+			if self.scanning:
+				return
+			if self.building is None:
+				current = self.current
+				if current is not None and len(current) <= current.capacity \
+						and self.clock() < self.next_scan:
+					return
+				capacity = self.capacity
+				if current is not None:
+					capacity = max(capacity, 2 * len(current))
+				self.building = BloomFilter(capacity, self.error_rate)
+				self.cursor = None
+			self.scanning = True
+			cursor = self.cursor
+		finally:
+			self.lock.release()
+		try:
+			names, cursor = users.user_store().nicknames(cursor, self.batch_size)
+		except:
+			self.scanning = False
+			raise
+		self.lock.acquire()
+		try:
+			for name in names:
+				self.building.add(name)
+			self.cursor = cursor
+			if cursor is None:
+				self.current, self.building = self.building, None
+				self.next_scan = self.clock() + self.rescan_interval
+			self.scanning = False
+		finally:
+			self.lock.release()
+
+	def add(self, nickname):
+		"""Record a nickname taken or confirmed on this instance."""
+		self.lock.acquire()
+		try:
+			for f in (self.current, self.building):
+				if f is not None:
+					f.add(nickname)
+		finally:
+			self.lock.release()
+
+	def available(self, nickname):
+		"""Return True if no user has this nickname."""
+		self.step()
+		current = self.current
+		if current is not None and nickname not in current:
+			METRICS.incr('nicknames.definite_miss')
+			return True
+		return get_user(nickname) is None
+
+
+NICKNAMES = NicknameIndex()
+
+def nickname_available(nickname):
+	return NICKNAMES.available(nickname)
+
+
+class CheckNickname(webapp.RequestHandler):
+	def get(self):
+		nickname = self.request.get('nickname')
+		available = bool(nickname) and nickname_available(nickname)
+		self.response.headers['Content-Type'] = 'application/json'
+		self.response.out.write(json.dumps({'nickname': nickname,
+			'available': available}, sort_keys=True))
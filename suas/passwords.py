@@ -0,0 +1,200 @@
+#/usr/bin/env python2.5
+#-----------------------
+
+"""
+Password hashing for User.pwd.
+
+Passwords are stored as '$'-separated fields starting with the name of
+the key derivation function and its cost, so that the cost can be
+raised without invalidating the existing hashes:
+
+	pbkdf2_sha256$<iterations>$<salt>$<hash>
+
+Hashes in the original 'salt$hash' format (a single salted SHA-256, see
+salt_n_hash) are still accepted; needs_rehash() tells when a hash
+should be replaced after a successful login.
+
+Hashing is CPU-bound.  To bound the number of hashes computed at once
+on an instance, install a HashPool with set_hash_pool(); otherwise they
+run on the calling thread, unbounded.
+
+>>> pwd = make_password('secret', cost=1000)
+>>> pwd.startswith('pbkdf2_sha256$1000$')
+True
+>>> check_password('secret', pwd), check_password('guess', pwd)
+(True, False)
+>>> check_password('secret', salt_n_hash('secret'))
+True
+>>> set_hash_pool(HashPool(2))
+>>> check_password('secret', pwd)
+True
+>>> set_hash_pool(None)
+
+Hashes read from the Datastore are unicode:
+
+>>> check_password(u'secret', unicode(pwd)), check_password(u'secret', u'\xe9$x')
+(True, False)
+"""
+
+import hmac
+import struct
+import hashlib
+from base64 import b64encode as b64
+from binascii import hexlify, unhexlify
+from hashlib import sha256
+from random import SystemRandom
+from threading import Semaphore
+from time import time
+
+from signedcookie import compare_digest
+from workers import WorkerPool
+
+N_SALT = 8             # length of the password salt
+
+PASSWORD_ALGORITHM = 'pbkdf2_sha256'
+# the key derivation function used for new hashes.
+
+PBKDF2_ITERATIONS = hasattr(hashlib, 'pbkdf2_hmac') and 20000 or 5000
+# the cost of new hashes; see calibrate().  Without hashlib.pbkdf2_hmac
+# (Python < 2.7.8, e.g. the 2.5 runtime), PBKDF2 runs in pure Python at
+# about 8us per iteration, so the default is lower there to keep a login
+# around 40ms; existing hashes with more iterations are kept.
+
+_random = SystemRandom()
+_hash_pool = None
+
+
+def gen_salt():
+	return b64( ''.join(chr(_random.randint(0, 0xff)) for _ in range(N_SALT)) )
+
+def salt_n_hash(password, salt=None):
+	"""
+	Generate a salt and return in base64 encoding the hash of the
+	password with the salt and the character '$' prepended to it.
+
+	This is the original format, kept to verify existing hashes.
+	"""
+	salt = salt or gen_salt()
+	return salt + '$' + b64( sha256(salt+password.encode("ascii")).digest() )
+
+
+def _pbkdf2_sha256(password, salt, iterations, dklen=32):
+	"""PBKDF2-HMAC-SHA256 in pure Python (RFC 2898)."""
+	prf = hmac.new(password, digestmod=sha256)
+	blocks = []
+	for index in range(1, -(-dklen // 32) + 1):
+		h = prf.copy()
+		h.update(salt + struct.pack('>I', index))
+		u = h.digest()
+		acc = long(hexlify(u), 16)
+		for _ in xrange(iterations - 1):
+			h = prf.copy()
+			h.update(u)
+			u = h.digest()
+			acc ^= long(hexlify(u), 16)
+		blocks.append(unhexlify('%064x' % acc))
+	return ''.join(blocks)[:dklen]
+
+def pbkdf2_sha256(password, salt, iterations):
+	if hasattr(hashlib, 'pbkdf2_hmac'):
+		return hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+	return _pbkdf2_sha256(password, salt, iterations)
+
+KDFS = {
+	'pbkdf2_sha256': pbkdf2_sha256,
+}
+
+def current_cost(algorithm):
+	return PBKDF2_ITERATIONS
+
+
+def _encode(password):
+	if isinstance(password, unicode):
+		return password.encode('utf-8')
+	return password
+
+def _derive(algorithm, password, salt, cost):
+	return b64( KDFS[algorithm](_encode(password), salt, cost) )
+
+def make_password(password, algorithm=None, cost=None):
+	"""Return the encoded hash of password, for storing in User.pwd."""
+	algorithm = algorithm or PASSWORD_ALGORITHM
+	if cost is None:
+		cost = current_cost(algorithm)
+	salt = gen_salt()
+	digest = run_hash(_derive, algorithm, password, salt, cost)
+	return '%s$%d$%s$%s' % (algorithm, cost, salt, digest)
+
+def check_password(password, encoded):
+	"""Return True if password matches the encoded hash."""
+	if isinstance(encoded, unicode):
+		# compare_digest takes str on both sides
+		try:
+			encoded = encoded.encode('ascii')
+		except UnicodeError:
+			return False
+	fields = encoded.split('$')
+	if len(fields) == 2:
+		expected = run_hash(salt_n_hash, password, fields[0])
+		return compare_digest(expected, encoded)
+	if len(fields) != 4 or fields[0] not in KDFS:
+		return False
+	algorithm, cost, salt, digest = fields
+	return compare_digest(
+		run_hash(_derive, algorithm, password, salt, int(cost)), digest)
+
+def needs_rehash(encoded):
+	"""
+	Return True if encoded was not made with the current algorithm
+	and at least the current cost.
+	"""
+	fields = encoded.split('$')
+	if len(fields) != 4 or fields[0] != PASSWORD_ALGORITHM:
+		return True
+	return int(fields[1]) < current_cost(PASSWORD_ALGORITHM)
+
+
+def calibrate(target_ms=100, algorithm=None):
+	"""
+	Set the cost of new hashes so that one takes about target_ms
+	milliseconds on this machine, and return it.
+	"""
+	global PBKDF2_ITERATIONS
+	algorithm = algorithm or PASSWORD_ALGORITHM
+	sample = 10000
+	start = time()
+	_derive(algorithm, 'password', 'saltsalt', sample)
+	elapsed = max(time() - start, 1e-6)
+	PBKDF2_ITERATIONS = max(1000, int(sample * target_ms / (elapsed * 1000)))
+	return PBKDF2_ITERATIONS
+
+
+class HashPool(WorkerPool):
+	"""
+	A WorkerPool computing password hashes.  At most size hashes run
+	at once, which bounds the CPU spent on logins regardless of how
+	many arrive at once: on the workers, or where there are none (see
+	workers.threads_allowed), on the calling threads, which wait for
+	one of the size slots.
+	"""
+	def __init__(self, size=2, backlog=64):
+		WorkerPool.__init__(self, size, backlog)
+		self.slots = Semaphore(size)
+
+	def call(self, future, func, args):
+		self.slots.acquire()
+		try:
+			WorkerPool.call(self, future, func, args)
+		finally:
+			self.slots.release()
+
+
+def set_hash_pool(pool):
+	"""Run hashing on pool (a HashPool), or inline if pool is None."""
+	global _hash_pool
+	_hash_pool = pool
+
+def run_hash(func, *args):
+	if _hash_pool is None:
+		return func(*args)
+	return _hash_pool.run(func, *args)
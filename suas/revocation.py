@@ -0,0 +1,245 @@
+#/usr/bin/env python2.5
+#-----------------------
+
+"""
+Revocation of sessions before SESSION_TTL: single SIDs (e.g. on
+logout, so that a copied cookie stops working) and every session of a
+user issued before a cutoff time ("log out everywhere").
+
+Revocations are Revocation entities.  Each instance keeps them in a
+RevocationList: revoked SIDs in a Bloom filter, and the per-user
+cutoffs in a dictionary.  Every SYNC_INTERVAL seconds, the next check
+queries the revocations stored since the last sync, so checking a
+session is a memory-only lookup; only a SID matching the filter is
+confirmed with a Datastore get, which false positives make rare.
+
+The filter is loaded with the revocations of the last SESSION_TTL
+LOAD_BATCH_SIZE at a time, one batch per check, so that no request
+pays for the whole load; until the load completes, each check looks
+up the session's revocations with a Datastore get.  The same happens
+when the filter is rebuilt.
+
+To check every session as it is opened, set session.REVOCATIONS:
+
+	session.REVOCATIONS = RevocationList()
+
+Revocations become effective on other instances within SYNC_INTERVAL
+(plus the Datastore's query consistency delay).  They are useless once
+SESSION_TTL has passed; sweep_revocations() deletes those, run by
+sweeper.SweepExpired.
+"""
+
+from threading import Lock
+from time import time
+
+from google.appengine.ext import db
+
+from bloom import BloomFilter
+from lru import LRUCache
+from session import SESSION_TTL
+
+SYNC_INTERVAL = 30     # 30s
+# the minimum interval between two syncs of a RevocationList.
+
+SYNC_OVERLAP = 60      # 60s
+# how far back before the last sync each sync queries again, so that
+# revocations which were not visible to the previous query are not
+# missed.
+
+LOAD_BATCH_SIZE = 500
+# the number of revocations loaded per check while a RevocationList
+# is loaded or rebuilt.
+
+REVOKED_CAPACITY = 100000
+REVOKED_ERROR_RATE = 0.001
+# the size of the Bloom filter of revoked SIDs: about 180KB.  If more
+# SIDs are revoked within SESSION_TTL, it is rebuilt from the Datastore
+# with twice the capacity.
+
+
+class Revocation(db.Model):
+	"""
+	A revoked SID, with key name 's' + SID, or the cutoff of a user,
+	with key name 'u' + nickname.
+	"""
+	cutoff = db.IntegerProperty()
+	stamp = db.FloatProperty(required=True)
+
+
+class RevocationList(object):
+	"""
+	Attributes:
+		sids		the Bloom filter of revoked SIDs, or None while the
+					first load is in progress
+		cutoffs		nickname -> time before which its sessions are revoked
+		capacity	the capacity of sids, doubled when it is exceeded
+		building	the filter being loaded, or None
+	"""
+	def __init__(self, capacity=REVOKED_CAPACITY, error_rate=REVOKED_ERROR_RATE,
+			sync_interval=SYNC_INTERVAL, batch_size=LOAD_BATCH_SIZE, clock=time):
+		self.capacity = capacity
+		self.error_rate = error_rate
+		self.sync_interval = sync_interval
+		self.batch_size = batch_size
+		self.clock = clock
+		self.lock = Lock()
+		self.reset()
+
+	def reset(self):
+		self.sids = None
+		self.cutoffs = {}
+		self.confirmed = LRUCache(1024, self.sync_interval)	# sid -> bool
+		self.synced = None
+		self.next_sync = 0
+		self.building = None
+		self.syncing = False
+
+	def start_load(self, now):
+		self.building = BloomFilter(self.capacity, self.error_rate)
+		self.building_cutoffs = {}
+		self.load_since = self.last_stamp = now - SESSION_TTL
+		self.cursor = None
+
+	def add(self, revocation, sids, cutoffs):
+		name = revocation.key().name()
+		if name[0] == 's':
+			sids.add(name[1:])
+		else:
+			nickname = name[1:]
+			cutoffs[nickname] = max(cutoffs.get(nickname, 0), revocation.cutoff)
+
+	def sync(self, force=False):
+		"""
+		Load the next batch of revocations if a load is in progress,
+		starting one at first or when sids is past its capacity.
+		Otherwise add the revocations stored since the last sync, if
+		it was more than sync_interval ago or force is true.  The
+		queries run without the lock, one sync at a time.
+		"""
+		now = self.clock()
+		self.lock.acquire()
+		try:
+			if self.syncing:
+				return
+			if self.building is None:
+				if self.sids is None:
+					self.start_load(now)
+				elif len(self.sids) > self.capacity:
+					self.capacity = max(self.capacity, 2 * len(self.sids))
+					self.start_load(now)
+				elif not force and now < self.next_sync:
+					return
+			self.syncing = True
+		finally:
+			self.lock.release()
+		try:
+			if self.building is not None:
+				self.load(now)
+			else:
+				self.update(now)
+		finally:
+			self.syncing = False
+
+	def load(self, now):
+		query = Revocation.all().filter('stamp >', self.load_since).order('stamp')
+		if self.cursor:
+			query.with_cursor(self.cursor)
+		revocations = query.fetch(self.batch_size)
+		self.lock.acquire()
+		try:
+			for revocation in revocations:
+				self.add(revocation, self.building, self.building_cutoffs)
+				self.last_stamp = max(self.last_stamp, revocation.stamp)
+			if len(revocations) == self.batch_size:
+				self.cursor = query.cursor()
+				return
+			self.sids, self.cutoffs = self.building, self.building_cutoffs
+			self.building = None
+			self.synced = max(self.last_stamp, now - SYNC_OVERLAP)
+			self.next_sync = now + self.sync_interval
+		finally:
+			self.lock.release()
+
+	def update(self, now):
+		since = self.synced - SYNC_OVERLAP
+		query = Revocation.all().filter('stamp >', since).order('stamp')
+		revocations = list(query)
+		self.lock.acquire()
+		try:
+			for revocation in revocations:
+				self.add(revocation, self.sids, self.cutoffs)
+				since = max(since, revocation.stamp)
+			self.synced = max(since, now - SYNC_OVERLAP)
+			self.next_sync = now + self.sync_interval
+		finally:
+			self.lock.release()
+
+	def is_revoked(self, sid, nickname=None, issued=None):
+		"""
+		Return True if the session with this SID, of the user with this
+		nickname and issued at this time, was revoked.  A session whose
+		issue time is unknown is revoked by any cutoff of its user.
+		While the revocations are (re)loaded, they are looked up with a
+		Datastore get instead.
+		"""
+		self.sync()
+		if self.building is not None:
+			return self.fetch_revoked(sid, nickname, issued)
+		if nickname is not None and nickname in self.cutoffs:
+			if issued is None or issued < self.cutoffs[nickname]:
+				return True
+		if sid not in self.sids:
+			return False
+		revoked = self.confirmed.get(sid)
+		if revoked is None:
+			revoked = Revocation.get_by_key_name('s' + sid) is not None
+			self.confirmed[sid] = revoked
+		return revoked
+
+	def fetch_revoked(self, sid, nickname, issued):
+		names = ['s' + sid]
+		if nickname is not None:
+			names.append('u' + nickname)
+		found = Revocation.get_by_key_name(names)
+		if found[0] is not None:
+			return True
+		if nickname is not None and found[1] is not None:
+			return issued is None or issued < found[1].cutoff
+		return False
+
+	def revoke_session(self, sid):
+		"""Revoke the session with this SID."""
+		Revocation(key_name='s' + sid, stamp=self.clock()).put()
+		self.lock.acquire()
+		try:
+			for sids in (self.sids, self.building):
+				if sids is not None:
+					sids.add(sid)
+			self.confirmed[sid] = True
+		finally:
+			self.lock.release()
+
+	def revoke_user(self, nickname, before=None):
+		"""Revoke the sessions of a user issued before a time, now by default."""
+		cutoff = int(before or self.clock())
+		Revocation(key_name='u' + nickname, cutoff=cutoff, stamp=self.clock()).put()
+		self.lock.acquire()
+		try:
+			cutoffs = [self.cutoffs]
+			if self.building is not None:
+				cutoffs.append(self.building_cutoffs)
+			for c in cutoffs:
+				c[nickname] = max(c.get(nickname, 0), cutoff)
+		finally:
+			self.lock.release()
+
+
+def sweep_revocations(batch_size=100):
+	"""
+	Delete a batch of revocations older than SESSION_TTL; return the
+	number deleted.
+	"""
+	query = Revocation.all(keys_only=True).filter('stamp <', time() - SESSION_TTL)
+	keys = query.fetch(batch_size)
+	db.delete(keys)
+	return len(keys)
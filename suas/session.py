@@ -13,10 +13,13 @@ cookies are signed using the SID and the site's secret key, ensuring that:
 	* Cookies were really issued by the server for a particular session.
 
 The RequestHandler class extends webapp.RequestHandler to provide
-access to the current session as an instance variable.
+access to the current session as an instance variable.  It works on
+its own, or under middleware.SessionMiddleware which makes the session
+available to any WSGI application.
 
 Limitations:
-	* currently unsigned cookies are simply ignored
+	* unsigned cookies, and cookies whose signature does not verify,
+		are simply ignored; a bad SID invalidates the whole session
 """
 
 from time import time, gmtime
@@ -25,34 +28,147 @@ from hashlib import md5
 
 from google.appengine.ext import webapp
 
-from signedcookie import SignedCookie, BadSignatureError, SIG_LEN
-from users import User
+from signedcookie import SignedCookie, BadSignatureError, HMACSigner, \
+	encode_envelope, decode_envelope, derive_key
+from users import get_user
+from metrics import METRICS
 
 SECRET_KEY = 'Open, sesame!'
 # A secret key unique to your application.
 
+KEY_RING = None
+# A signedcookie.KeyRing to use instead of SECRET_KEY, so that the
+# secret can be rotated without ending every session at once, e.g.
+#	KEY_RING = KeyRing({'1': 'new secret'}, current='1', legacy=SECRET_KEY)
+# and later
+#	KEY_RING = KeyRing({'1': 'new secret', '2': 'newer'}, current='2')
+# Cookies signed with a non-current key are signed again when the
+# session is flushed.
+
 SESSION_TTL = 604800    # 604800s = 7d
 # the life time of a "persistent" session authenticator, in seconds.
 # As long as the user comes back within that time frame, we will nenew
 # his session for a full period.  In case he doesn't, he will have to
 # login again.
 
-SID_TTL = 900           # 900s = 15m
-# the minimum interval between requests after which
-# we expire the old and issue a new ID.
+SID_TTL = 3600          # 3600s = 1h
+# the age after which we expire the old and issue a new ID, at the
+# next request.  The issue time is part of the ID.
+
+TOUCH_TTL = 900         # 900s = 15m
+# the minimum interval between requests after which we refresh
+# 'atime', re-signing and sending that cookie alone.  SIDs issued
+# before the ID carried its issue time are regenerated instead.
+
+REVOCATIONS = None
+# A revocation.RevocationList checked by every session as it is opened,
+# or None to trust sessions until they expire.
+
+ENVELOPE_COOKIE = 'session'
+# the name of the single cookie used by EnvelopeSession.
+
+ENVIRON_KEY = 'suas.session'
+# the WSGI environ key of the SessionLoader of the current request.
 
 
 class NoSIDError(Exception):
 	pass
 
-class CookieSession:
+
+def cookie_signer(suffix=''):
+	"""
+	Return the signer of the site's cookies, using SECRET_KEY or
+	KEY_RING followed by suffix.
+	"""
+	if KEY_RING is None:
+		return HMACSigner(SECRET_KEY + suffix)
+	return KEY_RING.signer(suffix)
+
+
+class SessionConfig(object):
+	"""
+	The settings of the sessions of one application or tenant, so that
+	several can be served by one process:
+
+		acme = SessionConfig('master secret', tenant='acme', session_ttl=3600)
+		app = SessionMiddleware(app, config=acme)
+
+	With a tenant, the secrets are derived from secret_key (or from
+	each secret of key_ring) by signedcookie.derive_key, once, when the
+	config is made; cookies of one tenant do not verify for another.
+
+	Attributes:
+		secret			the signing secret, if there is no key_ring
+		key_ring		a KeyRing, or None
+		session_ttl, sid_ttl, touch_ttl
+						as SESSION_TTL, SID_TTL and TOUCH_TTL
+		revocations		as REVOCATIONS
+		envelope_cookie	as ENVELOPE_COOKIE
+		store_cookie	as store.STORE_COOKIE, which None stands for
+	"""
+	def __init__(self, secret_key=None, key_ring=None, tenant=None,
+			session_ttl=SESSION_TTL, sid_ttl=SID_TTL, touch_ttl=TOUCH_TTL,
+			revocations=None, envelope_cookie=ENVELOPE_COOKIE, store_cookie=None):
+		if secret_key is None and key_ring is None:
+			raise ValueError("A SessionConfig needs a secret_key or a key_ring")
+		if secret_key is not None:
+			secret_key = secret_key.encode('ascii')
+			if tenant is not None:
+				secret_key = derive_key(secret_key, tenant)
+		if key_ring is not None and tenant is not None:
+			key_ring = key_ring.derive(tenant)
+		self.secret = secret_key
+		self.key_ring = key_ring
+		self.tenant = tenant
+		self.session_ttl = session_ttl
+		self.sid_ttl = sid_ttl
+		self.touch_ttl = touch_ttl
+		self.revocations = revocations
+		self.envelope_cookie = envelope_cookie
+		self.store_cookie = store_cookie
+		if key_ring is None:
+			# signers hold no per-request state, except those of a KeyRing
+			self.base_signer = HMACSigner(self.secret)
+	
+	def signer(self, suffix=''):
+		"""Return the signer of cookies, using the secrets followed by suffix."""
+		if self.key_ring is not None:
+			return self.key_ring.signer(suffix)
+		if not suffix:
+			return self.base_signer
+		return HMACSigner(self.secret + suffix)
+
+
+class ModuleConfig(SessionConfig):
+	"""
+	The config of the module globals, read as they are used, so that
+	setting e.g. session.REVOCATIONS still takes effect at once.
+	"""
+	def __init__(self):
+		self.tenant = self.store_cookie = None
+	
+	secret = property(lambda self: SECRET_KEY)
+	key_ring = property(lambda self: KEY_RING)
+	session_ttl = property(lambda self: SESSION_TTL)
+	sid_ttl = property(lambda self: SID_TTL)
+	touch_ttl = property(lambda self: TOUCH_TTL)
+	revocations = property(lambda self: REVOCATIONS)
+	envelope_cookie = property(lambda self: ENVELOPE_COOKIE)
+	
+	def signer(self, suffix=''):
+		return cookie_signer(suffix)
+
+DEFAULT_CONFIG = ModuleConfig()
+# the config of sessions made without one.
+
+class CookieSession(object):
 	"""
 	Provides dictionary-like storage/access to signed cookies.
 	The keys 'SID', 'user', and 'atime' are internally used by the
 	session object and the request handler, do not change them.
 	
 	Attributes:
-		user			the current user
+		user			the current user, fetched on first access
 		
 		flash_msg	a possible flash message set by the previous page,
 						automatically popped from the 'flash_msg' cookie
@@ -65,34 +181,69 @@ class CookieSession:
 	Instance methods:
 		start(user, persist=False)
 		end()
+		collect()
+		flush()
+
+	Changes are not written to the response as they are made: the
+	keys set, deleted or regenerated are marked dirty, and collect()
+	returns one 'Set-Cookie' value per dirty key.  flush() adds them
+	to the response; RequestHandler or SessionMiddleware do that once
+	at the end of the request, so setting the same key several times
+	in a request sends only its final state.  You can still call
+	set_cookie to add a header immediately.
 
-	Do not set/del the same key multiple times, as each __setitem__
-	call adds a 'Set-Cookie' header in the response.  This is due
-	to webapp's inability to deals directly with cookies or delete
-	multi-valued headers.  You can modify the cookies attribute
-	directly which do not modify the response, then call set_cookie
-	to add a header manually.
+	The response may be None, e.g. under SessionMiddleware, in which
+	case set_cookie keeps the header for collect() to return.
 
 	Also, since cookie values are strings, you will need to do
 	serialization/deserialization yourself, if necessary.
 	"""
-	def __init__(self, user, response):
+	def __init__(self, user, response=None, cookies=None, config=None):
 		self.user = user
 		self.response = response
+		self.config = config or DEFAULT_CONFIG
 		self.persist = False
-		id = self.__gen_id()
-		self.cookies = SignedCookie(SECRET_KEY + id)
-		self.cookies['SID'] = id
-		self.cookies['atime'] = repr( timegm(gmtime()) )
+		self.dirty = set()
+		self.pending_headers = []
+		if cookies is None:
+			id = self._gen_id()
+			cookies = SignedCookie(self.config.signer(id))
+			cookies['SID'] = id
+			cookies['atime'] = repr( timegm(gmtime()) )
+		self.cookies = cookies
+	
+	def _get_user(self):
+		if self._nickname is not None:
+			t = METRICS.start()
+			self._user = get_user(self._nickname)
+			METRICS.stop('session.user_fetch', t)
+			self._nickname = None
+		return self._user
+	
+	def _set_user(self, user):
+		self._user = user
+		self._nickname = None
+	
+	user = property(_get_user, _set_user)
 	
-	def __gen_id(self):
+	def _gen_id(self):
 		# This is predictable, but that's ok.
 		# We just need it to be unique, *especially* for different users
-		if self.user is None:
-			name = 'Anonymous'
+		if self._nickname is not None:
+			name = self._nickname
+		elif self._user is not None:
+			name = self._user.nickname
 		else:
-			name = self.user.nickname
-		return md5( name + repr(time()) ).hexdigest()
+			name = 'Anonymous'
+		now = time()
+		return '%s.%x' % (md5( name + repr(now) ).hexdigest(), int(now))
+	
+	def sid_issued(self):
+		"""Return the time the SID was issued at, or None if unknown."""
+		try:
+			return int( self['SID'].rsplit('.', 1)[1], 16 )
+		except (KeyError, IndexError, ValueError):
+			return None
 	
 	def __getitem__(self, key):
 		return self.cookies[key].value
@@ -119,41 +270,84 @@ class CookieSession:
 	def __setitem__(self, key, value):
 		self.cookies[key] = value
 		if self.persist:
-			self.cookies[key]['max-age'] = SESSION_TTL
-		self.set_cookie( key )
+			self.cookies[key].max_age = self.config.session_ttl
+		self.dirty.add( key )
 	
 	def set_cookie(self, key):
-		self.response.headers.add_header(
-			'Set-Cookie', self.cookies[key].output()[12:]
-			)
+		value = self.cookies[key].OutputString()
+		if self.response is None:
+			self.pending_headers.append(value)
+		else:
+			self.response.headers.add_header('Set-Cookie', value)
+	
+	def collect(self):
+		"""
+		Return the 'Set-Cookie' header values for the dirty keys, after
+		signing again the cookies that were verified with a non-current
+		key, and mark the keys clean.
+		"""
+		stale = self.cookies.signer.stale
+		if stale:
+			for key in list(stale):
+				entry = self.cookies.get(key)
+				if entry is not None and entry.max_age != 0:
+					self.cookies[key] = entry.value
+					self.dirty.add( key )
+			stale.clear()
+		values = self.pending_headers
+		values.extend( self.cookies[key].OutputString() for key in sorted(self.dirty) )
+		self.pending_headers = []
+		self.dirty.clear()
+		return values
+	
+	def flush(self):
+		"""
+		Add the 'Set-Cookie' headers returned by collect() to the
+		response.  Without a response, e.g. under SessionMiddleware,
+		do nothing: the headers are collected at the end of the request.
+		"""
+		if self.response is None:
+			return
+		for value in self.collect():
+			self.response.headers.add_header('Set-Cookie', value)
 	
 	def __delitem__(self, key):
 		self.expire_cookie(key)
 	
 	def expire_cookie(self, key):
-		self.cookies[key]['max-age'] = 0
-		self.set_cookie( key )
+		self.cookies[key].max_age = 0
+		self.dirty.add( key )
 	
 	@classmethod
-	def load(klass, request, response):
+	def load(klass, request, response=None, config=None):
 		"""
 		Load the session cookies from the request,
 		returning a new instance with the response.
+		The user is only fetched when first accessed.
 		"""
+		return klass.load_header(request.environ.get('HTTP_COOKIE', ''),
+			response, config)
+	
+	@classmethod
+	def load_header(klass, header, response=None, config=None):
+		"""Load the session cookies from a 'Cookie' header value."""
+		config = config or DEFAULT_CONFIG
+		c = SignedCookie(config.signer())
+		c.load(header)
+		id = c.peek('SID')
+		if id is None:
+			raise NoSIDError
+		c.signer = config.signer(id)
 		try:
-			id = request.cookies['SID'][1:-SIG_LEN-1]
+			c['SID']
+		except BadSignatureError:
+			raise
 		except KeyError:
 			raise NoSIDError
-		else:
-			c = SignedCookie(SECRET_KEY + id)
-			c.load(request.environ['HTTP_COOKIE'])
-			try:
-				user = User.get_by_key_name(c['user'].value)
-			except KeyError:
-				user = None
-			session = klass(user, response)
-			session.cookies = c
-			return session
+		session = klass(None, response, c, config)
+		if c.has_key('user'):
+			session._nickname = c['user'].value
+		return session
 
 	def start(self, user, persist=False):
 		"""
@@ -167,8 +361,7 @@ class CookieSession:
 		self.user = user
 		self.persist = persist
 		if user is None:
-			self.set_cookie( 'SID' )
-			self.set_cookie( 'atime' )
+			self.dirty.update( ('SID', 'atime') )
 			if self.cookies.has_key ( 'user' ):
 				self.expire_cookie ( 'user' )
 		else:
@@ -176,18 +369,23 @@ class CookieSession:
 			self.regen()
 		## TODO: Cache-control
 	
+	def touch(self):
+		"""Refresh 'atime', keeping the SID."""
+		self['atime'] = repr( timegm(gmtime()) )
+	
 	def regen(self):
 		"""Regenerate a new SID"""
-		id = self.__gen_id()
-		c = SignedCookie(SECRET_KEY + id)
-		for key, morsel in self.cookies.items():
-			c[key] = morsel.value
-			c[key].update( morsel.items() )		## preserves Max-Age
-		c['SID'] = id
-		c['atime'] = repr( timegm(gmtime()) )
+		id = self._gen_id()
+		c = SignedCookie(self.config.signer(id))
+		values = dict( (key, entry.value) for key, entry in self.cookies.items() )
+		values['SID'] = id
+		values['atime'] = repr( timegm(gmtime()) )
+		c.set_many( values.items() )
+		for key, entry in self.cookies.items():
+			new = c[key]		## preserves Max-Age
+			new.max_age, new.path = entry.max_age, entry.path
 		self.cookies = c
-		for k in self.cookies.keys():
-			self.set_cookie( k )
+		self.dirty.update( self.cookies.keys() )
 	
 	def end(self):
 		"""Expire all cookies"""
@@ -196,32 +394,261 @@ class CookieSession:
 			self.expire_cookie( key )
 
 
+class EnvelopeSession(CookieSession):
+	"""
+	A CookieSession that keeps all of its keys in one signed,
+	versioned and possibly compressed cookie named ENVELOPE_COOKIE,
+	instead of one signed cookie per key.  Loading it takes a single
+	signature verification, and flush() sends a single header.
+
+	The envelope is signed with config.signer() alone since it carries
+	the SID inside.  Values must be strings, as with CookieSession.
+
+	Attributes:
+		data		the dictionary of session keys
+	"""
+	def __init__(self, user, response=None, cookies=None, config=None):
+		self.user = user
+		self.response = response
+		self.config = config or DEFAULT_CONFIG
+		self.persist = False
+		self.dirty = set()
+		self.pending_headers = []
+		self.cookies = cookies or SignedCookie(self.config.signer())
+		self.data = {}
+		self.data['SID'] = self._gen_id()
+		self.data['atime'] = repr( timegm(gmtime()) )
+	
+	def __getitem__(self, key):
+		return self.data[key]
+	
+	def get(self, key, default=None):
+		return self.data.get(key, default)
+	
+	def __setitem__(self, key, value):
+		self.data[key] = str(value)
+		self.dirty.add(self.config.envelope_cookie)
+	
+	def collect(self):
+		"""
+		Return the 'Set-Cookie' header values, including the envelope's
+		if it changed or was signed with a non-current key.
+		"""
+		if self.cookies.signer.stale:
+			self.cookies.signer.stale.clear()
+			self.dirty.add(self.config.envelope_cookie)
+		values, self.pending_headers = self.pending_headers, []
+		if not self.dirty:
+			return values
+		self.dirty.clear()
+		name = self.config.envelope_cookie
+		if self.data:
+			self.cookies[name] = encode_envelope(self.data)
+			if self.persist:
+				self.cookies[name].max_age = self.config.session_ttl
+		else:
+			self.cookies[name] = ''
+			self.cookies[name].max_age = 0
+		values.append( self.cookies[name].OutputString() )
+		return values
+	
+	def expire_cookie(self, key):
+		self.data.pop(key, None)
+		self.dirty.add(self.config.envelope_cookie)
+	
+	@classmethod
+	def load_header(klass, header, response=None, config=None):
+		"""Load the session envelope from a 'Cookie' header value."""
+		config = config or DEFAULT_CONFIG
+		c = SignedCookie(config.signer())
+		c.load(header)
+		try:
+			data = decode_envelope(c[config.envelope_cookie].value)
+		except BadSignatureError:
+			raise
+		except (KeyError, ValueError):
+			raise NoSIDError
+		if 'SID' not in data:
+			raise NoSIDError
+		session = klass(None, response, c, config)
+		session.data = data
+		if 'user' in data:
+			session._nickname = data['user']
+		return session
+	
+	def start(self, user, persist=False):
+		self.user = user
+		self.persist = persist
+		if user is None:
+			self.data.pop('user', None)
+			self.dirty.add(self.config.envelope_cookie)
+		else:
+			self.data['user'] = user.nickname
+			self.regen()
+	
+	def regen(self):
+		"""Regenerate a new SID"""
+		self.data['SID'] = self._gen_id()
+		self.data['atime'] = repr( timegm(gmtime()) )
+		self.dirty.add(self.config.envelope_cookie)
+	
+	def end(self):
+		"""Expire the envelope cookie"""
+		self.user = None
+		self.data = {}
+		self.dirty.add(self.config.envelope_cookie)
+
+
+def open_session(session_class, header, response=None, config=None):
+	"""
+	Return the session of a request with the 'Cookie' header value,
+	popping its flash message, and expiring, regenerating or touching it
+	as needed, with the settings of config (DEFAULT_CONFIG by default).
+	"""
+	config = config or DEFAULT_CONFIG
+	t = METRICS.start()
+	try:
+		session = session_class.load_header(header, response, config)
+	except NoSIDError:
+		METRICS.incr('session.no_sid')
+		return session_class(None, response, config=config)
+	except BadSignatureError:
+		METRICS.incr('session.bad_signature')
+		return session_class(None, response, config=config)
+	METRICS.stop('session.load', t)
+	session.flash_msg = session.pop('flash_msg', '')
+	revocations = config.revocations
+	if revocations is not None and revocations.is_revoked(session['SID'],
+			session._nickname, session.sid_issued()):
+		METRICS.incr('session.revoked')
+		session.end()
+		return session
+	now = timegm( gmtime() )
+	try:
+		atime = int( session['atime'] )
+	except (KeyError, ValueError):
+		METRICS.incr('session.expired')
+		session.end()
+		return session
+	if now - atime > config.session_ttl:
+		METRICS.incr('session.expired')
+		session.end()
+		return session
+	issued = session.sid_issued()
+	if issued is None:
+		due = now - atime > config.touch_ttl
+	else:
+		due = now - issued > config.sid_ttl
+	if due:
+		METRICS.incr('session.regen')
+		t = METRICS.start()
+		session.regen()
+		METRICS.stop('session.regen', t)
+	elif now - atime > config.touch_ttl:
+		METRICS.incr('session.touch')
+		session.touch()
+	return session
+
+
+class SessionLoader(object):
+	"""
+	Open the session of a WSGI request on first access, and hand out
+	its 'Set-Cookie' headers at the end of the request.
+
+	Attributes:
+		session		the session, opened by open_session() on first access
+		config		the SessionConfig of the session, or None for DEFAULT_CONFIG
+	"""
+	def __init__(self, environ, session_class=CookieSession, response=None,
+			config=None):
+		self.environ = environ
+		self.session_class = session_class
+		self.response = response
+		self.config = config
+		self._session = None
+	
+	def _get_session(self):
+		if self._session is None:
+			self._session = open_session(self.session_class,
+				self.environ.get('HTTP_COOKIE', ''), self.response, self.config)
+		return self._session
+	
+	def _set_session(self, session):
+		self._session = session
+	
+	session = property(_get_session, _set_session)
+	
+	def headers(self):
+		"""
+		Return the 'Set-Cookie' header values of the session, if it was
+		opened, and end the metrics of the request.
+		"""
+		values = []
+		if self._session is not None:
+			values = self._session.collect()
+			if METRICS.sink is not None and self._session.cookies.bad:
+				METRICS.incr('cookie.bad_signature', len(self._session.cookies.bad))
+		METRICS.end_request(self.environ.get('PATH_INFO', ''))
+		return values
+
+
 class RequestHandler(webapp.RequestHandler):
 	"""
 	A session-capable request handler.
 	
 	Attribute:
-		session
+		session		loaded from the request cookies on first access,
+					so handlers that never use it pay nothing
+	
+	Class attributes:
+		session_class	CookieSession or EnvelopeSession, or None for
+						the SessionMiddleware's, or CookieSession
+		session_config	a SessionConfig, or None for the
+						SessionMiddleware's, or DEFAULT_CONFIG
+	
+	Under SessionMiddleware, the middleware's session is opened with
+	the handler's session_class and session_config where they are set;
+	initialize() raises ValueError if it was already opened, e.g. by
+	AsyncSessionLoader.
 	"""
+	session_class = None
+	session_config = None
+	
 	def initialize(self, request, response):
 		super(RequestHandler, self).initialize(request, response)
-		try:
-			self.session = CookieSession.load(request, response)
-		except NoSIDError:
-			self.session = CookieSession(None, self.response)
-		except BadSignatureError:
-			self.session = CookieSession(None, self.response)
+		loader = request.environ.get(ENVIRON_KEY)
+		if loader is not None:
+			self.configure_loader(loader)
 		else:
-			self.session.flash_msg = self.session.pop('flash_msg', '')
-			now = timegm( gmtime() )
-			try:
-				atime = int( self.session['atime'] )
-			except ValueError:
-				self.session.end()
-				return
-			if now - atime > SESSION_TTL:
-				self.session.end()
-				return
-			if now - atime > SID_TTL:
-				self.session.regen()
-
+			# not under SessionMiddleware: add the headers ourselves
+			loader = SessionLoader(request.environ,
+				self.session_class or CookieSession, response, self.session_config)
+			wsgi_write = response.wsgi_write
+			def flush_and_write(start_response):
+				for value in loader.headers():
+					response.headers.add_header('Set-Cookie', value)
+				wsgi_write(start_response)
+			response.wsgi_write = flush_and_write
+		self.session_loader = loader
+	
+	def configure_loader(self, loader):
+		"""
+		Have the SessionMiddleware's loader open the session with our
+		session_class and session_config, where they are set.
+		"""
+		session_class = self.session_class or loader.session_class
+		config = self.session_config or loader.config
+		if session_class is loader.session_class and config is loader.config:
+			return
+		if loader._session is not None:
+			raise ValueError("The session was opened before %s could set its "
+				"session_class or session_config" % type(self).__name__)
+		loader.session_class, loader.config = session_class, config
+	
+	def _get_session(self):
+		return self.session_loader.session
+	
+	def _set_session(self, session):
+		self.session_loader.session = session
+	
+	session = property(_get_session, _set_session)
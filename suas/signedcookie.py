@@ -13,8 +13,15 @@ really intended for the particular key.
 
 Each cookie is signed with HMAC-SHA256.
 
-SignedCookie inherits from SimpleCookie and share the same API.
+SignedCookie shares the API of SimpleCookie, without its weight: each
+cookie is a CookieEntry, which keeps the value, the signature and the
+Max-Age and Path attributes only, and whose OutputString() makes the
+'Set-Cookie' header value directly.
 A SignedCookie is constructed with a secret key as the argument.
+Signing and verification are delegated to a signer object, by default
+an HMACSigner, which can be replaced through the signer_class attribute.
+A signer, such as one made by KeyRing.signer(), can also be passed
+instead of the secret key.
 
 >>> c = SignedCookie('Open, sesame!')
 >>> c['user'] = 'username'
@@ -22,8 +29,11 @@ A SignedCookie is constructed with a secret key as the argument.
 'username'
 >>> c['user'].coded_value
 '"usernameCu/vp7hQJ8QsnLoMvFyM6jwyqAyZMIdJcpUZRBE6JYU="'
+>>> c['user'].max_age = 3600
+>>> c['user'].OutputString()
+'user="usernameCu/vp7hQJ8QsnLoMvFyM6jwyqAyZMIdJcpUZRBE6JYU="; Max-Age=3600'
 
-Loading also works.
+Loading also works.  Signatures are checked when a cookie is first read.
 
 >>> c.load('Cookie: itemid="12345mwKEC0M1343j/uvi3DIwLsiQWw7UP0Ue/84NxBUwljI="; Max-Age=100')
 >>> c['itemid'].value
@@ -34,10 +44,15 @@ Loading also works.
 
 import re
 import hmac
+import zlib
 from hashlib import sha256
-from base64 import b64encode, b64decode
+from base64 import b64encode, urlsafe_b64encode, urlsafe_b64decode
+from urllib import urlencode
+from cgi import parse_qsl
 import Cookie
 
+from lru import LRUCache
+
 
 SIG_LEN = 44		# the length of a sha256 hash string is 32,
 				# thus a base64 encoding of that block 
@@ -47,77 +62,528 @@ SIG_PATTERN = re.compile(r'[0-9a-zA-Z+/=]{44}')
 # This is the regex pattern for the signature generated by SignedCookie
 # which is base64 blob of length 44.
 
-class BadSignatureError(Exception):
+KEY_ID_PATTERN = re.compile(r'^[0-9a-zA-Z]$')
+# Key ids of a KeyRing are single alphanumeric characters.
+
+ENVELOPE_VERSION = '1'
+# The format version of the envelopes made by encode_envelope.
+
+ENVELOPE_COMPRESS_MIN = 200
+# Serialized envelopes at least this long are zlib-compressed,
+# provided that makes them shorter.
+
+PREPARED_MACS = LRUCache(4096)
+# (secret, cookie name) -> HMAC object with the key schedule done,
+# shared by all HMACSigner instances.
+
+class BadSignatureError(KeyError):
 	pass
 
-class SignedCookie(Cookie.SimpleCookie):
+
+def constant_time_compare(a, b):
+	"""
+	Compare two strings in time independent of where they differ.
+	"""
+	if len(a) != len(b):
+		return False
+	result = 0
+	for x, y in zip(a, b):
+		result |= ord(x) ^ ord(y)
+	return result == 0
+
+compare_digest = getattr(hmac, 'compare_digest', constant_time_compare)
+
+def derive_key(secret, label):
+	"""
+	Return a secret derived from secret for a label, e.g. a tenant
+	name, so that cookies signed for one label are not valid for
+	another.
+
+	>>> derive_key('Open, sesame!', 'acme')[:16]
+	'11dc0dab31a104cc'
+	>>> derive_key('Open, sesame!', 'initech')[:16]
+	'55eb2ead27de3913'
+	"""
+	return hmac.new(secret, 'suas.session:' + label, sha256).hexdigest()
+
+def split_signed(s, n=SIG_LEN):
+	"""
+	Split s into (value, signature) where the signature is the last n
+	characters, starting with a base64 digest; return None if s does
+	not end with something shaped like that.
+	"""
+	if len(s) < n or not SIG_PATTERN.match(s, len(s) - n):
+		return None
+	return s[:-n], s[-n:]
+
+
+class HMACSigner(object):
+	"""
+	Sign and verify cookie values with HMAC-SHA256, keyed with the
+	secret followed by the cookie name.
+
+	The HMAC object for each (secret, name) is created once and kept in
+	PREPARED_MACS; signing copies it instead of hashing the padded key
+	again.  Signatures are the base64 of the digest, SIG_LEN long.
+
+	>>> s = HMACSigner('Open, sesame!')
+	>>> s.sign('user', 'username')
+	'Cu/vp7hQJ8QsnLoMvFyM6jwyqAyZMIdJcpUZRBE6JYU='
+	>>> s.verify_many([('user', 'username', _), ('user', 'other', _)])
+	[True, False]
+	"""
+	stale = frozenset()
+
+	def __init__(self, secret):
+		self.secret = secret
+		self.macs = {}
+
+	def split(self, s):
+		"""
+		Split a signed value into (value, signature), or return None
+		if s does not end with something shaped like a signature.
+		"""
+		return split_signed(s)
+
+	def mac(self, name):
+		"""Return a fresh copy of the prepared HMAC for a cookie name."""
+		try:
+			return self.macs[name].copy()
+		except KeyError:
+			key = (self.secret, name)
+			h = PREPARED_MACS.get(key)
+			if h is None:
+				h = hmac.new(self.secret + name, digestmod=sha256)
+				PREPARED_MACS[key] = h
+			self.macs[name] = h
+			return h.copy()
+
+	def sign(self, name, value):
+		h = self.mac(name)
+		h.update(value)
+		return b64encode(h.digest())
+
+	def verify(self, name, value, sig):
+		return compare_digest(self.sign(name, value), sig)
+
+	def sign_many(self, items):
+		"""Return the signatures of a sequence of (name, value) pairs."""
+		return [self.sign(name, value) for name, value in items]
+
+	def verify_many(self, items):
+		"""
+		Verify a sequence of (name, value, sig) triples,
+		returning a list of booleans.
+		"""
+		return [self.verify(name, value, sig) for name, value, sig in items]
+
+
+class KeyRing(object):
+	"""
+	A set of secrets, each with a one character id, for rotating the
+	secret without invalidating the cookies signed with the previous
+	ones.
+
+	Cookies are signed with the current secret, and the signature is
+	followed by '.' and the key id, so that verification uses the right
+	secret at once.  Cookies signed with any other secret in the ring
+	are still accepted, and reported by the signer as stale so they can
+	be signed again; remove a secret from the ring to retire it.
+
+	Cookies signed without a key id, e.g. with SECRET_KEY before the ring
+	was set up, are accepted if legacy is that secret.
+
+	>>> ring = KeyRing({'1': 'old secret'}, current='1')
+	>>> s = ring.signer('SID')
+	>>> signed = 'foo' + s.sign('user', 'foo')
+	>>> signed[-2:]
+	'.1'
+	>>> ring = KeyRing({'1': 'old secret', '2': 'new secret'}, current='2')
+	>>> s = ring.signer('SID')
+	>>> s.verify('user', *s.split(signed)), s.stale
+	(True, set(['user']))
+	"""
+	def __init__(self, keys, current, legacy=None):
+		for kid in keys:
+			if not KEY_ID_PATTERN.match(kid):
+				raise ValueError("Bad key id %r" % kid)
+		if current not in keys:
+			raise ValueError("The current key %r is not in the ring" % current)
+		self.keys = dict(keys)
+		self.current = current
+		self.legacy = legacy
+
+	def signer(self, suffix=''):
+		"""
+		Return a signer using each secret of the ring followed by
+		suffix, e.g. a session ID.
+		"""
+		return KeyRingSigner(self, suffix)
+
+	def derive(self, label):
+		"""Return a ring of the secrets derived for label by derive_key."""
+		legacy = self.legacy
+		if legacy is not None:
+			legacy = derive_key(legacy, label)
+		return KeyRing(dict( (kid, derive_key(secret, label))
+			for kid, secret in self.keys.items() ), self.current, legacy)
+
+
+class KeyRingSigner(object):
+	"""Sign and verify with the secrets of a KeyRing; see KeyRing."""
+	def __init__(self, ring, suffix):
+		self.ring = ring
+		self.suffix = suffix
+		self.signers = {}	# key id -> HMACSigner
+		self.stale = set()	# names of cookies verified with an old key
+
+	def signer(self, kid):
+		try:
+			return self.signers[kid]
+		except KeyError:
+			if kid is None:
+				secret = self.ring.legacy
+			else:
+				secret = self.ring.keys.get(kid)
+			if secret is None:
+				return None
+			signer = self.signers[kid] = HMACSigner(secret + self.suffix)
+			return signer
+
+	def split(self, s):
+		if s[-2:-1] == '.':
+			return split_signed(s, SIG_LEN + 2)
+		if self.ring.legacy is not None:
+			return split_signed(s)
+		return None
+
+	def sign(self, name, value):
+		kid = self.ring.current
+		return self.signer(kid).sign(name, value) + '.' + kid
+
+	def verify(self, name, value, sig):
+		if sig[-2:-1] == '.':
+			kid = sig[-1]
+			sig = sig[:-2]
+		else:
+			kid = None
+		signer = self.signer(kid)
+		if signer is None or not signer.verify(name, value, sig):
+			return False
+		if kid != self.ring.current:
+			self.stale.add(name)
+		return True
+
+	def sign_many(self, items):
+		return [self.sign(name, value) for name, value in items]
+
+	def verify_many(self, items):
+		return [self.verify(name, value, sig) for name, value, sig in items]
+
+
+
+def encode_envelope(data):
+	"""
+	Serialize a dictionary of strings into a single cookie-safe
+	string, to be stored and signed as one cookie.
+
+	The result is the version, a flag ('p'lain or 'z'lib) and the
+	url-safe base64 of the url-encoded items.
+
+	>>> encode_envelope({'SID': 'abc', 'user': 'foo'})
+	'1pU0lEPWFiYyZ1c2VyPWZvbw'
+	>>> decode_envelope(_) == {'SID': 'abc', 'user': 'foo'}
+	True
+	"""
+	payload = urlencode(sorted(data.items()))
+	flag = 'p'
+	if len(payload) >= ENVELOPE_COMPRESS_MIN:
+		packed = zlib.compress(payload)
+		if len(packed) < len(payload):
+			payload, flag = packed, 'z'
+	return ENVELOPE_VERSION + flag + urlsafe_b64encode(payload).rstrip('=')
+
+def decode_envelope(s):
+	"""
+	Return the dictionary serialized by encode_envelope.
+	Raise ValueError if s is not a valid envelope.
+	"""
+	if s[:1] != ENVELOPE_VERSION or s[1:2] not in ('p', 'z'):
+		raise ValueError("Unknown envelope format")
+	body = s[2:]
+	try:
+		payload = urlsafe_b64decode(body + '=' * (-len(body) % 4))
+		if s[1] == 'z':
+			payload = zlib.decompress(payload)
+	except (TypeError, zlib.error):
+		raise ValueError("Corrupt envelope")
+	return dict(parse_qsl(payload, keep_blank_values=True))
+
+
+ATTRIBUTES = {'max-age': 'max_age', 'path': 'path'}
+# The cookie attributes kept by CookieEntry, by lowercase name.
+
+class CookieEntry(object):
+	"""
+	A cookie of a SignedCookie: its value and signature, and the only
+	attributes sessions set, Max-Age and Path.  The quoted value sent
+	to browsers is made when first needed.
+
+	Attributes can also be read and set as with a Cookie.Morsel,
+	e.g. entry['max-age'] = 0.
+	"""
+	__slots__ = ('key', 'value', 'sig', 'coded', 'max_age', 'path')
+
+	def __init__(self, key, value, sig, coded=None):
+		self.key = key
+		self.value = value
+		self.sig = sig
+		self.coded = coded
+		self.max_age = self.path = None
+
+	def coded_value(self):
+		if self.coded is None:
+			self.coded = Cookie._quote(self.value + self.sig)
+		return self.coded
+	coded_value = property(coded_value)
+
+	def __getitem__(self, name):
+		return getattr(self, ATTRIBUTES[name.lower()])
+
+	def __setitem__(self, name, value):
+		try:
+			setattr(self, ATTRIBUTES[name.lower()], value)
+		except KeyError:
+			raise Cookie.CookieError("Invalid Attribute %s" % name)
+
+	def items(self):
+		return [(name, getattr(self, attr)) for name, attr in ATTRIBUTES.items()
+			if getattr(self, attr) is not None]
+
+	def update(self, items):
+		for name, value in items:
+			self[name] = value
+
+	def OutputString(self):
+		"""Return the value of this cookie's 'Set-Cookie' header."""
+		s = '%s=%s' % (self.key, self.coded_value)
+		if self.max_age is not None:
+			s += '; Max-Age=%d' % int(self.max_age)
+		if self.path is not None:
+			s += '; Path=%s' % self.path
+		return s
+
+	def output(self, attrs=None, header='Set-Cookie:'):
+		return '%s %s' % (header, self.OutputString())
+
+	def __repr__(self):
+		return '<%s: %s=%r>' % (self.__class__.__name__, self.key, self.value)
+
+class SignedCookie(dict):
+	"""
+	A jar of signed cookies: a dictionary of CookieEntry by name, with
+	the loading and output methods of Cookie.SimpleCookie.
+	"""
+	__slots__ = ('key', 'signer', 'pending', 'bad')
+
+	signer_class = HMACSigner
+
 	def __init__(self, key, input=None):
 		"""
 		Initialize the Cookie with a secret key.
 		"""
-		self.key = key.encode('ascii')
+		if isinstance(key, basestring):
+			self.key = key.encode('ascii')
+			self.signer = self.signer_class(self.key)
+		else:
+			self.key = None
+			self.signer = key
+		self.pending = {}	# key -> unverified CookieEntry
+		self.bad = set()	# keys which failed verification
 		if input:
 			self.load(input)
 	
 	def __setitem__(self, key, value):
+		key = str(key)
 		strval = str(value)
-		sig = b64encode(
-			hmac.new(self.key + str(key), strval, sha256).digest()
-			)
-		cval = Cookie._quote( strval + sig )
-		self._BaseCookie__set(key, strval, cval)
-	
-	## Copied verbatim from Cookie.py
-	## This has to be here to be able to use our implementation of __ParseString
+		self.__discard(key)
+		dict.__setitem__(self, key,
+			CookieEntry(key, strval, self.signer.sign(key, strval)))
+	
+	def set_many(self, items):
+		"""Set a sequence of (key, value) pairs, signing them in a batch."""
+		items = [(str(k), str(v)) for k, v in items]
+		sigs = self.signer.sign_many(items)
+		for (key, strval), sig in zip(items, sigs):
+			self.__discard(key)
+			dict.__setitem__(self, key, CookieEntry(key, strval, sig))
+	
+	def __discard(self, key):
+		self.pending.pop(key, None)
+		self.bad.discard(key)
+	
+	## Signatures are verified on first access.  A cookie whose signature
+	## does not verify is treated as absent, except that looking it up
+	## with [] raises BadSignatureError (a KeyError) instead of KeyError.
+	
+	def __getitem__(self, key):
+		if key in self.pending:
+			self.__verify([key])
+		try:
+			return dict.__getitem__(self, key)
+		except KeyError:
+			if key in self.bad:
+				raise BadSignatureError("Bad signature for cookie '%s'" % key)
+			raise
+	
+	def get(self, key, default=None):
+		try:
+			return self[key]
+		except KeyError:
+			return default
+	
+	def has_key(self, key):
+		return self.get(key) is not None
+	
+	__contains__ = has_key
+	
+	def peek(self, key):
+		"""
+		Return the value of a cookie without verifying its signature,
+		or None.  This is how the secret of a cookie whose signer
+		depends on one of its values can be found: peek at the value,
+		then set the signer attribute before reading anything else.
+		"""
+		entry = self.pending.get(key) or dict.get(self, key)
+		if entry is not None:
+			return entry.value
+	
+	def verify_all(self):
+		"""Verify all pending cookies in a batch."""
+		if self.pending:
+			self.__verify(self.pending.keys())
+	
+	def keys(self):
+		self.verify_all()
+		return dict.keys(self)
+	
+	def values(self):
+		self.verify_all()
+		return dict.values(self)
+	
+	def items(self):
+		self.verify_all()
+		return dict.items(self)
+	
+	def __iter__(self):
+		self.verify_all()
+		return dict.__iter__(self)
+	
+	def __len__(self):
+		self.verify_all()
+		return dict.__len__(self)
+	
+	def __verify(self, keys):
+		entries = [self.pending.pop(key) for key in keys]
+		triples = [(e.key, e.value, e.sig) for e in entries]
+		for e, ok in zip(entries, self.signer.verify_many(triples)):
+			if ok:
+				dict.__setitem__(self, e.key, e)
+			else:
+				self.bad.add(e.key)
+	
+	def output(self, attrs=None, header='Set-Cookie:', sep='\r\n'):
+		"""Return the 'Set-Cookie' headers of all cookies, sorted by name."""
+		return sep.join( self[key].output(attrs, header) for key in sorted(self.keys()) )
+	
+	def __repr__(self):
+		return '<%s: %s>' % (self.__class__.__name__, ' '.join(
+			'%s=%r' % (key, self[key].value) for key in sorted(self.keys())))
+	
 	def load(self, rawdata):
 		"""Load cookies from a string (presumably HTTP_COOKIE) or
 		from a dictionary.  Loading cookies from a dictionary 'd'
 		is equivalent to calling:
 			map(Cookie.__setitem__, d.keys(), d.values())
+		Cookies loaded from a string are only indexed; each signature
+		is verified when the cookie is first read.
 		"""
-		if type(rawdata) == type(""):
-			self.__ParseString(rawdata)
+		if isinstance(rawdata, basestring):
+			self.__parse(rawdata)
 		else:
-			self.update(rawdata)
-		return
-	
-	## Copied from Cookie.py
-	## Changed the last block to use decode & verify signature
-	def __ParseString(self, str, patt=Cookie._CookiePattern):
-		i = 0			# Our starting point
-		n = len(str)		# Length of string
-		M = None		# current morsel
-
-		while 0 <= i < n:
-			# Start looking for a cookie
-			match = patt.search(str, i)
-			if not match: break		  # No more cookies
-
-			K,V = match.group("key"), match.group("val")
-			i = match.end(0)
-
-			# Parse the key, value in case it's metainfo
-			if K[0] == "$":
-				# We ignore attributes which pertain to the cookie
-				# mechanism as a whole.  See RFC 2109.
-				# (Does anyone care?)
-				if M:
-					M[ K[1:] ] = V
-			elif K.lower() in Cookie.Morsel._reserved:
-				if M:
-					M[ K ] = Cookie._unquote(V)
+			self.set_many(rawdata.items())
+	
+	def __parse(self, s):
+		"""
+		Index the signed cookies of s in a single pass.  Values which do
+		not end with something shaped like a signature are skipped.
+		"""
+		n = len(s)
+		i = 0
+		split = self.signer.split
+		reserved = Cookie.Morsel._reserved
+		entry = None		# the last signed cookie
+		while i < n:
+			eq = s.find('=', i)
+			if eq < 0:
+				break
+			semi = s.rfind(';', i, eq)
+			if semi >= 0:
+				i = semi + 1
+			K = s[i:eq].strip()
+			if ' ' in K:
+				K = K.split()[-1]	# e.g. 'Cookie: key'
+			j = eq + 1
+			while j < n and s[j] == ' ':
+				j += 1
+			if j < n and s[j] == '"':
+				end = j
+				while True:
+					end = s.find('"', end + 1)
+					if end < 0 or s[end - 1] != '\\':
+						break
+				if end < 0:
+					end = n
+				V = s[j:end + 1]
+				semi = s.find(';', end)
+			else:
+				semi = s.find(';', j)
+				V = s[j:(semi < 0 and n or semi)].rstrip()
+			i = semi < 0 and n or semi + 1
+			
+			if K[:1] == '$':
+				if entry is not None:
+					self.__attribute(entry, K[1:], V)
+			elif K.lower() in reserved:
+				if entry is not None:
+					self.__attribute(entry, K, Cookie._unquote(V))
 			else:
-				if not SIG_PATTERN.search(V):
-					pass
-				uval = Cookie._unquote(V)
-				real_val = uval[:-SIG_LEN]
-				try:
-					sig = b64decode( uval[-SIG_LEN:] )
-				except TypeError:
-					# Incorrect padding
-					raise BadSignatureError("Bad signature for cookie '%s'" % K)
-				# TODO: use constant time string comparison
-				if sig != hmac.new(self.key + K, real_val, sha256).digest():
-					raise BadSignatureError("Bad signature for cookie '%s'" % K)
-				self._BaseCookie__set(K, real_val, V)
-				M = self[K]
+				entry = None
+				signed = split(Cookie._unquote(V))
+				if signed is None:
+					continue
+				self.__discard(K)
+				if dict.has_key(self, K):
+					dict.__delitem__(self, K)
+				entry = self.pending[K] = CookieEntry(K, signed[0], signed[1], V)
+	
+	def __attribute(self, entry, name, value):
+		name = name.lower()
+		if name == 'path':
+			entry.path = value
+		elif name == 'max-age':
+			try:
+				entry.max_age = int(value)
+			except ValueError:
+				pass
+	
+	def load_signed(self, key, coded_value):
+		"""
+		Verify the signature of a single (possibly quoted) cookie
+		value as sent by the browser, and add it to the cookie.
+		"""
+		signed = self.signer.split(Cookie._unquote(coded_value))
+		if signed is None or not self.signer.verify(key, *signed):
+			raise BadSignatureError("Bad signature for cookie '%s'" % key)
+		self.__discard(key)
+		dict.__setitem__(self, key, CookieEntry(key, signed[0], signed[1], coded_value))
@@ -0,0 +1,330 @@
+#/usr/bin/env python2.5
+#-----------------------
+
+"""
+Server-side session storage: the cookie carries only the signed SID,
+and the session keys live in a store.
+
+A store maps a SID to a string, with:
+
+	get(sid)			return the string, or None
+	set(sid, value, ttl)	store value for ttl seconds
+	delete(sid)
+
+and optionally, for stores that know when a value expires:
+
+	get_with_ttl(sid)	return the string and the number of seconds
+					it has left, or (None, 0)
+
+Provided stores:
+	LRUStore		in-process; sessions are lost on restart and not
+					shared between instances
+	MemcacheStore	any memcache-protocol client, by default the App
+					Engine memcache API; LocalMemcache stands in for it
+	DatastoreStore	SessionData entities, swept by sweep_sessions(),
+					run by sweeper.SweepExpired
+	CachedStore		a read-through cache in front of another store,
+					filled only from a backend with get_with_ttl()
+
+StoreSession reads its data from the store on load and writes it
+back at the end of the request only if a key was changed.  Set its
+store attribute in a subclass to use another store than STORE:
+
+	class MySession(StoreSession):
+		store = CachedStore(DatastoreStore(), LRUStore())
+
+>>> s = LRUStore()
+>>> s.set('abc', 'user=foo', 60)
+>>> s.get('abc'), s.get('def')
+('user=foo', None)
+>>> m = MemcacheStore(LocalMemcache())
+>>> m.set('abc', 'user=foo', 60)
+>>> m.get('abc'), m.client.items.keys()
+('user=foo', [(None, 'suas.session:abc')])
+"""
+
+from time import time, gmtime
+from calendar import timegm
+from datetime import datetime, timedelta
+
+from google.appengine.ext import db
+
+from lru import LRUCache
+from signedcookie import SignedCookie, BadSignatureError, \
+	encode_envelope, decode_envelope
+from session import CookieSession, NoSIDError, DEFAULT_CONFIG, SESSION_TTL
+
+STORE_COOKIE = 'sid'
+# the name of the cookie holding the signed SID of a StoreSession.
+
+LRU_STORE_SIZE = 10000
+# the number of sessions kept by an LRUStore.
+
+MEMCACHE_NAMESPACE = 'suas.session'
+
+
+class LRUStore(object):
+	def __init__(self, maxsize=LRU_STORE_SIZE, ttl=None):
+		self.cache = LRUCache(maxsize, ttl or SESSION_TTL)
+
+	def get(self, sid):
+		return self.cache.get(sid)
+
+	def set(self, sid, value, ttl):
+		self.cache[sid] = value
+
+	def delete(self, sid):
+		self.cache.pop(sid)
+
+
+class LocalMemcache(object):
+	"""An in-process stand-in for a memcache client."""
+	def __init__(self, clock=time):
+		self.clock = clock
+		self.items = {}
+
+	def get(self, key, namespace=None):
+		item = self.items.get( (namespace, key) )
+		if item is None:
+			return None
+		value, expires = item
+		if expires and expires < self.clock():
+			del self.items[ (namespace, key) ]
+			return None
+		return value
+
+	def set(self, key, value, time=0, namespace=None):
+		expires = time and self.clock() + time
+		self.items[ (namespace, key) ] = (value, expires)
+		return True
+
+	def delete(self, key, namespace=None):
+		self.items.pop( (namespace, key), None )
+		return 2
+
+
+class MemcacheStore(object):
+	"""Keys are SIDs prefixed with namespace and ':'."""
+	def __init__(self, client=None, namespace=MEMCACHE_NAMESPACE):
+		if client is None:
+			from google.appengine.api import memcache
+			client = memcache
+		self.client = client
+		self.prefix = namespace + ':'
+
+	def get(self, sid):
+		return self.client.get(self.prefix + sid)
+
+	def set(self, sid, value, ttl):
+		self.client.set(self.prefix + sid, value, ttl)
+
+	def delete(self, sid):
+		self.client.delete(self.prefix + sid)
+
+
+class SessionData(db.Model):
+	"""The data of a StoreSession, keyed by SID."""
+	data = db.TextProperty()
+	expires = db.DateTimeProperty()
+
+
+class DatastoreStore(object):
+	def get(self, sid):
+		return self.get_with_ttl(sid)[0]
+
+	def get_with_ttl(self, sid):
+		entity = SessionData.get_by_key_name(sid)
+		if entity is None:
+			return None, 0
+		left = entity.expires - datetime.utcnow()
+		ttl = left.days * 86400 + left.seconds
+		if ttl <= 0:
+			return None, 0
+		return entity.data, ttl
+
+	def set(self, sid, value, ttl):
+		SessionData(key_name=sid, data=db.Text(value),
+			expires=datetime.utcnow() + timedelta(seconds=ttl)).put()
+
+	def delete(self, sid):
+		db.delete( db.Key.from_path(SessionData.kind(), sid) )
+
+
+def sweep_sessions(batch_size=100):
+	"""
+	Delete a batch of expired SessionData entities; return the number
+	deleted.  Call it from cron until it returns less than batch_size.
+	"""
+	query = SessionData.all(keys_only=True).filter('expires <', datetime.utcnow())
+	keys = query.fetch(batch_size)
+	db.delete(keys)
+	return len(keys)
+
+
+class CachedStore(object):
+	"""
+	Serve reads from cache, falling back to backend and filling the
+	cache for the time the value has left in backend; write and
+	delete through both.  If backend has no get_with_ttl() the cache
+	is only filled by writes.
+	"""
+	def __init__(self, backend, cache):
+		self.backend = backend
+		self.cache = cache
+
+	def get(self, sid):
+		value = self.cache.get(sid)
+		if value is not None:
+			return value
+		if not hasattr(self.backend, 'get_with_ttl'):
+			return self.backend.get(sid)
+		value, ttl = self.backend.get_with_ttl(sid)
+		if value is not None:
+			self.cache.set(sid, value, ttl)
+		return value
+
+	def set(self, sid, value, ttl):
+		self.backend.set(sid, value, ttl)
+		self.cache.set(sid, value, ttl)
+
+	def delete(self, sid):
+		self.backend.delete(sid)
+		self.cache.delete(sid)
+
+
+STORE = CachedStore(DatastoreStore(), MemcacheStore())
+# the store of StoreSession: memcache in front of the Datastore.
+
+
+class StoreSession(CookieSession):
+	"""
+	A session whose keys are kept in a store, under the SID carried
+	by the single signed cookie STORE_COOKIE (or the store_cookie of its
+	config).  Values must be strings,
+	as with CookieSession.
+
+	The data is written to the store by collect() if a key was set or
+	deleted since it was loaded, and only then.
+
+	Attributes:
+		data		the dictionary of session keys
+		cookie_name	the name of the SID cookie
+		store		the store, STORE unless set by a subclass
+		modified	True if data must be written back
+		stored		the SID the data is stored under, if any
+	"""
+	store = None
+
+	def __init__(self, user, response=None, cookies=None, config=None):
+		self.user = user
+		self.response = response
+		self.config = config or DEFAULT_CONFIG
+		self.cookie_name = self.config.store_cookie or STORE_COOKIE
+		self.persist = False
+		self.dirty = set()
+		self.pending_headers = []
+		self.cookies = cookies or SignedCookie(self.config.signer())
+		if self.store is None:
+			self.store = STORE
+		self.data = {}
+		self.data['SID'] = self._gen_id()
+		self.data['atime'] = repr( timegm(gmtime()) )
+		self.modified = False
+		self.stored = None
+
+	def __getitem__(self, key):
+		return self.data[key]
+
+	def get(self, key, default=None):
+		return self.data.get(key, default)
+
+	def __setitem__(self, key, value):
+		value = str(value)
+		if self.data.get(key) != value:
+			self.data[key] = value
+			self.modified = True
+
+	def expire_cookie(self, key):
+		if key in self.data:
+			del self.data[key]
+			self.modified = True
+
+	def collect(self):
+		"""
+		Write the data to the store if it was modified, and return the
+		'Set-Cookie' header values, including the SID cookie's if it
+		changed or was signed with a non-current key.
+		"""
+		sid = self.data.get('SID')
+		if self.stored is not None and self.stored != sid:
+			self.store.delete(self.stored)
+			self.stored = None
+		if self.data and self.modified:
+			self.store.set(sid, encode_envelope(self.data), self.config.session_ttl)
+			if self.stored is None:
+				self.dirty.add(self.cookie_name)
+			self.stored = sid
+		self.modified = False
+		if self.cookies.signer.stale:
+			self.cookies.signer.stale.clear()
+			self.dirty.add(self.cookie_name)
+		values, self.pending_headers = self.pending_headers, []
+		if not self.dirty:
+			return values
+		self.dirty.clear()
+		if self.data:
+			self.cookies[self.cookie_name] = self.data['SID']
+			if self.persist:
+				self.cookies[self.cookie_name].max_age = self.config.session_ttl
+		else:
+			self.cookies[self.cookie_name] = ''
+			self.cookies[self.cookie_name].max_age = 0
+		values.append( self.cookies[self.cookie_name].OutputString() )
+		return values
+
+	@classmethod
+	def load_header(klass, header, response=None, config=None):
+		"""Load the session from the store, by the SID of a 'Cookie' header value."""
+		config = config or DEFAULT_CONFIG
+		c = SignedCookie(config.signer())
+		c.load(header)
+		try:
+			sid = c[config.store_cookie or STORE_COOKIE].value
+		except BadSignatureError:
+			raise
+		except KeyError:
+			raise NoSIDError
+		session = klass(None, response, c, config)
+		value = session.store.get(sid)
+		if value is None:
+			raise NoSIDError
+		try:
+			session.data = decode_envelope(value)
+		except ValueError:
+			raise NoSIDError
+		session.stored = sid
+		if 'user' in session.data:
+			session._nickname = session.data['user']
+		return session
+
+	def start(self, user, persist=False):
+		self.user = user
+		self.persist = persist
+		if user is None:
+			self.expire_cookie('user')
+		else:
+			self.data['user'] = user.nickname
+			self.regen()
+
+	def regen(self):
+		"""Regenerate a new SID, moving the data to it."""
+		self.data['SID'] = self._gen_id()
+		self.data['atime'] = repr( timegm(gmtime()) )
+		self.modified = True
+		self.dirty.add(self.cookie_name)
+
+	def end(self):
+		"""Delete the stored data and expire the SID cookie."""
+		self.user = None
+		self.data = {}
+		self.dirty.add(self.cookie_name)
@@ -0,0 +1,76 @@
+#/usr/bin/env python2.5
+#-----------------------
+
+"""
+Delete signups that were never confirmed, and optionally the
+suspended users they were created for, with users.sweep_signups().
+
+Each call deletes one batch and returns a cursor to resume from, so
+the cost of a run is proportional to the number of stale signups,
+not to the number of users.
+
+SweepSignups, mounted at SWEEP_URL, runs one batch per request and
+chains a task for the next one; see cron.yaml.
+
+SweepExpired, mounted at EXPIRED_SWEEP_URL, does the same for the
+expired sessions of store.DatastoreStore and the revocations of
+revocation.py.
+"""
+
+from google.appengine.ext import webapp
+
+from users import sweep_signups
+from store import sweep_sessions
+from revocation import sweep_revocations
+
+SWEEP_URL = '/_suas/sweep'
+EXPIRED_SWEEP_URL = '/_suas/sweep_expired'
+
+SIGNUP_MAX_AGE = 7     # days
+# signups older than this are deleted.
+
+SWEEP_BATCH_SIZE = 100
+# the number of entities of each kind deleted per batch.
+
+
+def enqueue(url, params=None):
+	try:
+		from google.appengine.api import taskqueue
+	except ImportError:
+		from google.appengine.api.labs import taskqueue
+	taskqueue.add(url=url, params=params)
+
+
+class SweepSignups(webapp.RequestHandler):
+	"""
+	Sweep one batch, then enqueue a task for the next one.
+	Parameters: max_age (days), delete_users (1 or 0), cursor.
+	"""
+	def get(self):
+		self.post()
+
+	def post(self):
+		max_age = int(self.request.get('max_age', SIGNUP_MAX_AGE))
+		delete_users = self.request.get('delete_users') == '1'
+		n, cursor = sweep_signups(max_age, SWEEP_BATCH_SIZE,
+			self.request.get('cursor'), delete_users)
+		if cursor:
+			enqueue(SWEEP_URL, {'max_age': max_age,
+				'delete_users': delete_users and '1' or '0', 'cursor': cursor})
+		self.response.out.write('%d\n' % n)
+
+
+class SweepExpired(webapp.RequestHandler):
+	"""
+	Delete a batch of expired sessions and one of revocations, then
+	enqueue a task for the next ones if either batch was full.
+	"""
+	def get(self):
+		self.post()
+
+	def post(self):
+		sessions = sweep_sessions(SWEEP_BATCH_SIZE)
+		revocations = sweep_revocations(SWEEP_BATCH_SIZE)
+		if SWEEP_BATCH_SIZE in (sessions, revocations):
+			enqueue(EXPIRED_SWEEP_URL)
+		self.response.out.write('%d %d\n' % (sessions, revocations))
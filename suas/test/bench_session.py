@@ -0,0 +1,210 @@
+#!/usr/bin/env python2.5
+
+"""
+Microbenchmarks for cookie signing, parsing and the session lifecycle.
+
+Run from the SDK environment (the Datastore is the SDK's in-memory
+stub, so no network round trips are measured):
+
+	python bench_session.py                     # print results
+	python bench_session.py --save base.json    # save a baseline
+	python bench_session.py --compare base.json # compare with one
+
+Each benchmark reports operations per second (best of --repeat runs).
+Allocations are not reported: Python 2 has no tracemalloc, and the
+garbage collector's counters only give the net number of container
+objects left over, which is about 0 for code that does not leak.
+"""
+
+import sys, os
+from optparse import OptionParser
+from time import time, gmtime
+from calendar import timegm
+
+try:
+	import json
+except ImportError:
+	from django.utils import simplejson as json
+
+sys.path.append( os.path.abspath( os.path.join( os.path.dirname(__file__), '..') ) )
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore_file_stub
+from google.appengine.ext import webapp
+
+APP_ID = 'suas-bench'
+
+def setup_stubs():
+	os.environ['APPLICATION_ID'] = APP_ID
+	apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+	apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3',
+		datastore_file_stub.DatastoreFileStub(APP_ID, None, None))
+
+setup_stubs()
+
+from signedcookie import SignedCookie
+from session import CookieSession, SECRET_KEY
+from users import USER_CACHE, get_user
+from usermodels import User
+from passwords import salt_n_hash, make_password
+from userstore import SQLiteUserStore, StoredUser
+
+SID = 'bench3f8a9c2e1d'
+THIRD_PARTY = '; _ga=GA1.2.1234567890.1234567890; _gid=GA1.2.987654321.1234567890'
+
+
+def session_header(size):
+	"""Return a Cookie header of about size bytes holding a session."""
+	c = SignedCookie(SECRET_KEY + SID)
+	c['SID'] = SID
+	c['user'] = 'bench'
+	c['atime'] = timegm( gmtime() )
+	header = '; '.join( m.output()[12:] for m in c.values() ) + THIRD_PARTY
+	n = 0
+	while len(header) < size:
+		header += '; pref%d=%s' % (n, 'x' * 60)
+		n += 1
+	return header
+
+def request(header):
+	return webapp.Request({'HTTP_COOKIE': header, 'REQUEST_METHOD': 'GET',
+		'wsgi.url_scheme': 'http', 'SERVER_NAME': 'localhost',
+		'SERVER_PORT': '80', 'PATH_INFO': '/'})
+
+
+def bench_cookie_setitem():
+	c = SignedCookie(SECRET_KEY + SID)
+	def run():
+		c['user'] = 'bench'
+	return run
+
+def bench_cookie_load(size):
+	def factory():
+		header = session_header(size)
+		def run():
+			c = SignedCookie(SECRET_KEY + SID)
+			c.load(header)
+			c['SID'], c['user'], c['atime']
+		return run
+	return factory
+
+def bench_session_load(fetch_user):
+	def factory():
+		req = request(session_header(1024))
+		def run():
+			s = CookieSession.load(req, webapp.Response())
+			if fetch_user:
+				s.user
+		return run
+	return factory
+
+def bench_session_method(method):
+	def factory():
+		req = request(session_header(1024))
+		user = get_user('bench')
+		def run():
+			s = CookieSession.load(req, webapp.Response())
+			if method == 'start':
+				s.start(user)
+			else:
+				getattr(s, method)()
+			s.flush()
+		return run
+	return factory
+
+def bench_salt_n_hash():
+	def run():
+		salt_n_hash('correct horse battery staple')
+	return run
+
+def bench_make_password():
+	def run():
+		make_password('correct horse battery staple')
+	return run
+
+def bench_sqlite_get_user():
+	store = SQLiteUserStore()
+	store.put_user(StoredUser('bench', 'bench@example.org', salt_n_hash('bench'), False))
+	def run():
+		store.get_user('bench')
+	return run
+
+BENCHMARKS = [
+	('cookie_setitem', bench_cookie_setitem, 20000),
+	('cookie_load_1k', bench_cookie_load(1024), 5000),
+	('cookie_load_4k', bench_cookie_load(4096), 2000),
+	('session_load', bench_session_load(False), 5000),
+	('session_load_user', bench_session_load(True), 5000),
+	('session_regen', bench_session_method('regen'), 2000),
+	('session_start', bench_session_method('start'), 2000),
+	('session_end', bench_session_method('end'), 2000),
+	('salt_n_hash', bench_salt_n_hash, 20000),
+	('make_password', bench_make_password, 10),
+	('sqlite_get_user', bench_sqlite_get_user, 20000),
+]
+
+
+def measure(run, number, repeat):
+	"""Return the best ops/sec over repeat runs."""
+	run()	# warm up caches
+	best = 0
+	for _ in range(repeat):
+		start = time()
+		for _ in xrange(number):
+			run()
+		best = max(best, number / max(time() - start, 1e-9))
+	return best
+
+def run_all(names=None, repeat=3):
+	User(key_name='bench', nickname='bench', email='bench@example.org',
+		pwd=salt_n_hash('bench'), suspended=False).put()
+	USER_CACHE.clear()
+	results = {}
+	for name, factory, number in BENCHMARKS:
+		if names and name not in names:
+			continue
+		results[name] = {'ops_per_sec': round(measure(factory(), number, repeat), 1)}
+	return results
+
+def report(results, baseline=None, threshold=0.1):
+	"""
+	Print the results, compared with the baseline if given.
+	Return the names of the benchmarks slower than the baseline by
+	more than threshold.
+	"""
+	regressions = []
+	for name in sorted(results):
+		r = results[name]
+		line = '%-20s %12.1f ops/s' % (name, r['ops_per_sec'])
+		if baseline and name in baseline:
+			ratio = r['ops_per_sec'] / baseline[name]['ops_per_sec']
+			line += '   %+6.1f%%' % ((ratio - 1) * 100)
+			if ratio < 1 - threshold:
+				line += '  REGRESSION'
+				regressions.append(name)
+		print line
+	return regressions
+
+def main():
+	parser = OptionParser(usage='%prog [options] [benchmark ...]')
+	parser.add_option('--save', metavar='FILE', help='save the results as JSON')
+	parser.add_option('--compare', metavar='FILE', help='compare with a saved baseline')
+	parser.add_option('--repeat', type='int', default=3)
+	parser.add_option('--threshold', type='float', default=0.1,
+		help='slowdown ratio reported as a regression (default 0.1)')
+	options, names = parser.parse_args()
+	results = run_all(names, options.repeat)
+	baseline = None
+	if options.compare:
+		baseline = json.load(open(options.compare))['results']
+	regressions = report(results, baseline, options.threshold)
+	if options.save:
+		f = open(options.save, 'w')
+		json.dump({'python': sys.version.split()[0], 'time': int(time()),
+			'results': results}, f, indent=2, sort_keys=True)
+		f.close()
+	if regressions:
+		sys.exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python2.5
+
+"""
+Load test of main.APP: virtual users sign up, confirm, then log in,
+browse and log out, driven in-process from a pool of threads.
+
+Run from the SDK environment; the Datastore is the SDK's in-memory
+stub and mails are kept in a LocalMailQueue:
+
+	python load_session.py                      # print results
+	python load_session.py --save base.json     # save a baseline
+	python load_session.py --compare base.json  # compare with one
+
+Each virtual user has its own fake clock, which jumps ahead between
+page views, so that some of them cross TOUCH_TTL (label 'touch:atime'),
+SID_TTL ('touch:regen') or SESSION_TTL ('touch:expired').  The mix is
+drawn from a random generator seeded with --seed, and the numbers of
+users and sessions are fixed, so runs with the same options are
+comparable.  Reported per label: requests, and p50/p95/p99 latency.
+"""
+
+import sys, os
+import random
+from threading import Lock, Condition, local
+from optparse import OptionParser
+from StringIO import StringIO
+from urllib import urlencode
+from time import time, gmtime
+from math import ceil
+
+try:
+	import json
+except ImportError:
+	from django.utils import simplejson as json
+
+sys.path.append( os.path.abspath( os.path.join( os.path.dirname(__file__), '..', '..') ) )
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore_file_stub
+
+APP_ID = 'suas-load'
+
+def setup_stubs():
+	os.environ['APPLICATION_ID'] = APP_ID
+	apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+	apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3',
+		datastore_file_stub.DatastoreFileStub(APP_ID, None, None))
+
+setup_stubs()
+
+from main import APP
+from suas import session, auth_handlers, passwords
+from suas.mailqueue import LocalMailQueue
+from suas.throttle import LoginThrottle, TokenBucket
+from suas.workers import WorkerPool
+
+PASSWORD = 'correct horse battery staple'
+
+
+class FakeClock(object):
+	"""The time of each thread, offset from the real one by advance()."""
+	def __init__(self):
+		self.current = local()
+
+	def time(self):
+		return time() + getattr(self.current, 'offset', 0)
+
+	def gmtime(self, secs=None):
+		if secs is None:
+			secs = self.time()
+		return gmtime(secs)
+
+	def advance(self, seconds):
+		self.current.offset = getattr(self.current, 'offset', 0) + seconds
+
+	def reset(self):
+		self.current.offset = 0
+
+
+class Mailbox(object):
+	"""Deliver the mails of a LocalMailQueue into per-address lists."""
+	def __init__(self):
+		self.arrived = Condition()
+		self.boxes = {}
+
+	def send_batch(self, batch):
+		self.arrived.acquire()
+		try:
+			for sender, to, subject, body in batch:
+				self.boxes.setdefault(to, []).append(body)
+			self.arrived.notifyAll()
+		finally:
+			self.arrived.release()
+
+	def last(self, to, timeout=10):
+		"""
+		Return the last mail sent to an address, waiting for it since
+		another thread's flush may be delivering it.
+		"""
+		deadline = time() + timeout
+		self.arrived.acquire()
+		try:
+			while to not in self.boxes and time() < deadline:
+				self.arrived.wait(deadline - time())
+			return self.boxes[to][-1]
+		finally:
+			self.arrived.release()
+
+
+class Recorder(object):
+	def __init__(self):
+		self.lock = Lock()
+		self.latencies = {}		# label -> [seconds]
+		self.errors = 0
+
+	def record(self, label, seconds, ok):
+		self.lock.acquire()
+		try:
+			self.latencies.setdefault(label, []).append(seconds)
+			if not ok:
+				self.errors += 1
+		finally:
+			self.lock.release()
+
+
+class Browser(object):
+	"""A cookie jar sending requests to a WSGI application."""
+	def __init__(self, app, recorder):
+		self.app = app
+		self.recorder = recorder
+		self.cookies = {}
+
+	def request(self, label, method, path, params=None):
+		query, body = '', ''
+		if params and method == 'GET':
+			query = urlencode(params)
+		elif params:
+			body = urlencode(params)
+		environ = {'REQUEST_METHOD': method, 'PATH_INFO': path,
+			'QUERY_STRING': query, 'SERVER_NAME': 'localhost',
+			'SERVER_PORT': '80', 'HTTP_HOST': 'localhost',
+			'REMOTE_ADDR': '10.0.0.1', 'wsgi.url_scheme': 'http',
+			'wsgi.input': StringIO(body), 'wsgi.errors': sys.stderr,
+			'CONTENT_LENGTH': str(len(body)),
+			'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+			'HTTP_COOKIE': '; '.join('%s=%s' % c for c in self.cookies.items())}
+		response = {}
+		def start_response(status, headers, exc_info=None):
+			response['status'] = status
+			response['headers'] = headers
+		start = time()
+		''.join( self.app(environ, start_response) )
+		elapsed = time() - start
+		status = int(response['status'].split()[0])
+		self.recorder.record(label, elapsed, status < 400)
+		for name, value in response['headers']:
+			if name.lower() == 'set-cookie':
+				self.set_cookie(value)
+		return status
+
+	def set_cookie(self, header):
+		name, rest = header.split('=', 1)
+		if 'Max-Age=0' in rest:
+			self.cookies.pop(name, None)
+		else:
+			self.cookies[name] = rest.split(';', 1)[0]
+
+
+def virtual_user(n, options, clock, mailbox, recorder):
+	"""Sign up, then run options.sessions sessions of page views."""
+	rand = random.Random(options.seed * 100003 + n)
+	clock.reset()
+	browser = Browser(APP, recorder)
+	nickname = 'load%d' % n
+	email = nickname + '@example.org'
+	browser.request('signup', 'POST', '/signup', {'nickname': nickname,
+		'email': email, 'password': PASSWORD, 'password2': PASSWORD})
+	link = mailbox.last(email)
+	id = link[link.index('id=') + 3:].split('>')[0]
+	browser.request('confirm', 'GET', '/confirmsignup', {'id': id})
+	for _ in range(options.sessions):
+		browser.request('login', 'POST', '/login',
+			{'nickname': nickname, 'password': PASSWORD})
+		expired = False
+		for _ in range(options.views):
+			x = rand.random()
+			if x < options.expire_rate:
+				clock.advance(session.SESSION_TTL + 1)
+				label = 'touch:expired'
+				expired = True
+			elif x < options.expire_rate + options.regen_rate:
+				clock.advance(session.SID_TTL + 1)
+				label = 'touch:regen'
+			elif x < options.expire_rate + options.regen_rate + options.touch_rate:
+				clock.advance(session.TOUCH_TTL + 1)
+				label = 'touch:atime'
+			else:
+				clock.advance(rand.randint(1, 60))
+				label = 'touch'
+			browser.request(label, 'GET', '/')
+			if expired:
+				break
+		if not expired:
+			browser.request('logout', 'GET', '/logout')
+
+
+def percentile(sorted_values, p):
+	"""Return the nearest-rank p-th percentile of sorted_values."""
+	i = int( ceil(p / 100.0 * len(sorted_values)) ) - 1
+	return sorted_values[ max(0, min(i, len(sorted_values) - 1)) ]
+
+def run(options):
+	clock = FakeClock()
+	session.time = clock.time
+	session.gmtime = clock.gmtime
+	mailbox = Mailbox()
+	auth_handlers.MAIL_QUEUE = LocalMailQueue(send_batch=mailbox.send_batch)
+	if not options.throttle:
+		unlimited = lambda: TokenBucket(rate=0, burst=sys.maxint)
+		auth_handlers.LOGIN_THROTTLE = LoginThrottle(unlimited(), unlimited())
+	if options.iterations:
+		passwords.PBKDF2_ITERATIONS = options.iterations
+	recorder = Recorder()
+	pool = WorkerPool(options.threads, options.users)
+	start = time()
+	futures = [pool.submit(virtual_user, n, options, clock, mailbox, recorder)
+		for n in range(options.users)]
+	for future in futures:
+		future.get_result()
+	elapsed = time() - start
+	routes = {}
+	total = 0
+	for label, latencies in recorder.latencies.items():
+		latencies.sort()
+		total += len(latencies)
+		routes[label] = {'requests': len(latencies),
+			'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+			'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+			'p99_ms': round(percentile(latencies, 99) * 1000, 2)}
+	return {'requests_per_sec': round(total / elapsed, 1),
+		'flows_per_sec': round(options.users * options.sessions / elapsed, 1),
+		'errors': recorder.errors, 'routes': routes}
+
+def report(results, baseline=None):
+	print '%-15s %8s %9s %9s %9s' % ('label', 'requests', 'p50 ms', 'p95 ms', 'p99 ms')
+	for label in sorted(results['routes']):
+		r = results['routes'][label]
+		line = '%-15s %8d %9.2f %9.2f %9.2f' % (label, r['requests'],
+			r['p50_ms'], r['p95_ms'], r['p99_ms'])
+		if baseline and label in baseline['routes']:
+			b = baseline['routes'][label]
+			line += '   p95 %+6.1f%%' % ((r['p95_ms'] / max(b['p95_ms'], 1e-3) - 1) * 100)
+		print line
+	line = '%.1f requests/s, %.1f login flows/s, %d errors' % (
+		results['requests_per_sec'], results['flows_per_sec'], results['errors'])
+	if baseline:
+		line += '   throughput %+6.1f%%' % (
+			(results['requests_per_sec'] / baseline['requests_per_sec'] - 1) * 100)
+	print line
+
+OPTIONS = ('seed', 'users', 'sessions', 'views', 'threads', 'touch_rate',
+	'regen_rate', 'expire_rate', 'throttle', 'iterations')
+
+def main():
+	parser = OptionParser(usage='%prog [options]')
+	parser.add_option('--users', type='int', default=200)
+	parser.add_option('--sessions', type='int', default=3, help='per user')
+	parser.add_option('--views', type='int', default=10, help='per session')
+	parser.add_option('--threads', type='int', default=8)
+	parser.add_option('--seed', type='int', default=1)
+	parser.add_option('--touch-rate', type='float', default=0.1,
+		help='the share of views after more than TOUCH_TTL')
+	parser.add_option('--regen-rate', type='float', default=0.05,
+		help='the share of views after more than SID_TTL')
+	parser.add_option('--expire-rate', type='float', default=0.01,
+		help='the share of views after more than SESSION_TTL')
+	parser.add_option('--throttle', action='store_true',
+		help='keep the login throttle (off by default)')
+	parser.add_option('--iterations', type='int',
+		help='PBKDF2 iterations of new passwords (default: passwords.PBKDF2_ITERATIONS)')
+	parser.add_option('--save', metavar='FILE', help='save the results as JSON')
+	parser.add_option('--compare', metavar='FILE', help='compare with a saved baseline')
+	options, args = parser.parse_args()
+	results = run(options)
+	baseline = None
+	if options.compare:
+		saved = json.load(open(options.compare))
+		baseline = saved['results']
+		changed = [o for o in OPTIONS if saved['options'].get(o) != getattr(options, o)]
+		if changed:
+			print 'warning: options differ from the baseline:', ', '.join(changed)
+	report(results, baseline)
+	if options.save:
+		f = open(options.save, 'w')
+		json.dump({'python': sys.version.split()[0], 'time': int(time()),
+			'options': dict((o, getattr(options, o)) for o in OPTIONS),
+			'results': results}, f, indent=2, sort_keys=True)
+		f.close()
+
+if __name__ == '__main__':
+	main()
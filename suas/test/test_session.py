@@ -12,8 +12,23 @@ from google.appengine.ext.webapp import util
 import sys, os
 sys.path.append( os.path.abspath( os.path.join( os.path.dirname(__file__), '..') ) )
 
-from signedcookie import SignedCookie, SIG_LEN
-from session import RequestHandler, SECRET_KEY, SESSION_TTL, SID_TTL
+from signedcookie import SignedCookie, SIG_LEN, encode_envelope, decode_envelope, KeyRing
+import session
+from middleware import SessionMiddleware, get_session
+from asyncauth import AsyncSessionLoader, login_required_async, authenticate_async, \
+	session_user_async
+from workers import WorkerPool
+from store import StoreSession, LRUStore, CachedStore, LocalMemcache, STORE_COOKIE
+from revocation import RevocationList
+from userstore import SQLiteUserStore, StoredUser
+from nicknames import NicknameIndex
+from throttle import LoginThrottle, TokenBucket
+from passwords import make_password
+import auth_handlers
+import users
+from metrics import MemorySink, set_sink
+from session import RequestHandler, EnvelopeSession, SessionConfig, SECRET_KEY, \
+	SESSION_TTL, SID_TTL, TOUCH_TTL, ENVELOPE_COOKIE
 
 # mock
 class User:
@@ -25,13 +40,23 @@ class Login(RequestHandler):
 		nickname = self.request.get('nickname')
 		self.session.start(User(nickname))
 
+class LoginFlash(RequestHandler):
+	def post(self):
+		self.session.start(User(self.request.get('nickname')))
+		self.session['flash_msg'] = 'Welcome'
+		self.session['flash_msg'] = 'Welcome back'
+
 class Regen(RequestHandler):
 	def post(self):
 		self.session.regen()
 
 class Touch(RequestHandler):
-        def get(self):
-                pass
+	def get(self):
+		self.session
+
+class Static(RequestHandler):
+	def get(self):
+		self.response.out.write('static')
 
 class Logout(RequestHandler):
 	def get(self):
@@ -40,11 +65,51 @@ class Logout(RequestHandler):
 def application():
 	return webapp.WSGIApplication(
 			[	('/login', Login),
+				('/loginflash', LoginFlash),
 				('/regen', Regen),
 				('/touch', Touch),
+				('/static', Static),
 				('/logout', Logout)	],
 			debug=True)
 
+class EnvelopeLogin(Login):
+	session_class = EnvelopeSession
+
+class EnvelopeTouch(Touch):
+	session_class = EnvelopeSession
+
+class LocalStoreSession(StoreSession):
+	store = LRUStore()
+
+class StoreLogin(Login):
+	session_class = LocalStoreSession
+
+class StoreCart(RequestHandler):
+	session_class = LocalStoreSession
+
+	def post(self):
+		self.session['cart'] = self.request.get('cart')
+
+	def get(self):
+		self.response.out.write(self.session.get('cart', ''))
+
+def store_application():
+	return webapp.WSGIApplication(
+			[	('/login', StoreLogin),
+				('/cart', StoreCart)	],
+			debug=True)
+
+def envelope_application():
+	return webapp.WSGIApplication(
+			[	('/login', EnvelopeLogin),
+				('/touch', EnvelopeTouch)	],
+			debug=True)
+
+def forge_envelope(data):
+	c = SignedCookie(SECRET_KEY)
+	c[ENVELOPE_COOKIE] = encode_envelope(data)
+	return 'Cookie: ' + c[ENVELOPE_COOKIE].output()[12:]
+
 def test_login():
 	app = TestApp(application())
 
@@ -58,6 +123,31 @@ def test_login():
 	assert 'user="foo' in res
 	assert 'atime=' in res
 
+def test_coalesced_headers():
+	app = TestApp(application())
+
+	response = app.post( '/loginflash', {'nickname': 'foo'} )
+
+	res = str(response)
+	assert res.count('Set-Cookie:') == 4
+	assert res.count('flash_msg=') == 1
+	assert 'Welcome back' in res
+
+def test_lazy_session():
+	app = TestApp(application())
+
+	## forge an expired session cookie ##
+	SID = 'jdsf7823hsdfj'
+	c = SignedCookie(SECRET_KEY + SID)
+	c['SID'] = SID
+	c['user'] = 'foo'
+	c['atime'] = timegm( gmtime() ) - SESSION_TTL - 1
+	s = 'Cookie: '+ '; '.join( m.output()[12:] for m in c.values() )
+
+	response = app.get('/static', extra_environ={'HTTP_COOKIE': s})
+
+	assert 'Set-Cookie' not in str(response)
+
 def test_logout():
 	app = TestApp(application())
 
@@ -116,6 +206,24 @@ def test_autoregen():
 	assert new_user[:-SIG_LEN] == c['user'].value
 	assert new_user != c['user'].coded_value
 
+def test_autotouch():
+	app = TestApp(application())
+
+	## forge the session cookie, with a fresh SID ##
+	SID = 'ad8f7s6hj3kdf.%x' % int(time())
+	c = SignedCookie(SECRET_KEY + SID)
+	c['SID'] = SID
+	c['user'] = 'foo'
+	c['atime'] = timegm( gmtime() ) - TOUCH_TTL - 1
+	s = 'Cookie: '+ '; '.join( m.output()[12:] for m in c.values() )
+
+	response = app.get('/touch', extra_environ={'HTTP_COOKIE': s})
+
+	res = str(response)
+	assert res.count('Set-Cookie:') == 1
+	new_atime = re.search('atime="(.*)"', res).group(1)
+	assert int(new_atime[:-SIG_LEN]) > int(c['atime'].value)
+
 def test_autoexpire():
 	app = TestApp(application())
 
@@ -134,3 +242,431 @@ def test_autoexpire():
 	assert re.search('user=.*Max-Age=0', res)
 	assert re.search('atime=.*Max-Age=0', res)
 
+
+def test_envelope_login():
+	app = TestApp(envelope_application())
+
+	response = app.post( '/login', {'nickname': 'foo'} )
+
+	res = str(response)
+	assert 'SID=' not in res
+	assert res.count(ENVELOPE_COOKIE + '=') == 1
+
+def test_envelope_autoregen():
+	app = TestApp(envelope_application())
+
+	## forge the session envelope ##
+	SID = 'ewhf843hfidsh'
+	s = forge_envelope({'SID': SID, 'user': 'foo',
+		'atime': repr(timegm( gmtime() ) - SID_TTL - 1)})
+
+	response = app.get('/touch', extra_environ={'HTTP_COOKIE': s})
+
+	res = str(response)
+	coded = re.search(ENVELOPE_COOKIE + '=("[^"]*"|[^;]*)', res).group(1)
+	c = SignedCookie(SECRET_KEY)
+	c.load_signed(ENVELOPE_COOKIE, coded)
+	data = decode_envelope(c[ENVELOPE_COOKIE].value)
+	assert data['SID'] != SID
+	assert data['user'] == 'foo'
+
+def test_store_session():
+	app = TestApp(store_application())
+
+	response = app.post( '/login', {'nickname': 'foo'} )
+
+	res = str(response)
+	assert res.count('Set-Cookie:') == 1
+	assert 'user=' not in res
+	cookie = STORE_COOKIE + '=' + re.search(STORE_COOKIE + '=("[^"]*"|[^;]*)', res).group(1)
+
+	response = app.post( '/cart', {'cart': 'x' * 5000},
+		extra_environ={'HTTP_COOKIE': cookie} )
+	assert 'Set-Cookie:' not in str(response)
+
+	response = app.get( '/cart', extra_environ={'HTTP_COOKIE': cookie} )
+	assert response.body == 'x' * 5000
+	assert 'Set-Cookie:' not in str(response)
+
+class ExpiringStore(LRUStore):
+	"""An LRUStore whose values have 30 seconds left."""
+	def get_with_ttl(self, sid):
+		value = self.get(sid)
+		return value, value and 30 or 0
+
+def test_cached_store_ttl():
+	backend, cache = ExpiringStore(), LocalMemcache(clock=lambda: 1000)
+	backend.set('abc', 'user=foo', SESSION_TTL)
+	store = CachedStore(backend, cache)
+
+	assert store.get('abc') == 'user=foo'
+	assert cache.items[ (None, 'abc') ] == ('user=foo', 1030)
+	assert store.get('def') is None
+
+def test_envelope_compression():
+	data = {'SID': 'abc', 'blob': 'x' * 1000}
+	s = encode_envelope(data)
+	assert s[1] == 'z'
+	assert len(s) < 200
+	assert decode_envelope(s) == data
+
+def test_foreign_cookies_ignored():
+	app = TestApp(application())
+
+	## forge the session cookie, next to unsigned and forged ones ##
+	SID = 'kjhd8234hkjsdf'
+	c = SignedCookie(SECRET_KEY + SID)
+	c['SID'] = SID
+	c['user'] = 'foo'
+	c['atime'] = timegm( gmtime() )
+	forged = SignedCookie('not the secret')
+	forged['flash_msg'] = 'gotcha'
+	s = 'Cookie: _ga=GA1.2.345.678; ' + \
+		'; '.join( m.output()[12:] for m in c.values() + forged.values() )
+
+	response = app.get('/logout', extra_environ={'HTTP_COOKIE': s})
+
+	res = str(response)
+	assert re.search('user="foo.*Max-Age=0', res)
+	assert 'flash_msg' not in res
+	assert '_ga' not in res
+
+def test_metrics():
+	app = TestApp(application())
+	sink = MemorySink()
+	set_sink(sink)
+
+	## forge the session cookie ##
+	SID = 'lkd8324jhsdfkj'
+	c = SignedCookie(SECRET_KEY + SID)
+	c['SID'] = SID
+	c['user'] = 'foo'
+	c['atime'] = timegm( gmtime() ) - SID_TTL - 1
+	s = 'Cookie: '+ '; '.join( m.output()[12:] for m in c.values() )
+
+	try:
+		app.get('/touch', extra_environ={'HTTP_COOKIE': s})
+		app.get('/static', extra_environ={'HTTP_COOKIE': s})
+	finally:
+		set_sink(None)
+
+	stats = sink.snapshot()
+	assert stats['requests'] == 2
+	assert stats['counters'] == {'session.regen': 1}
+	assert stats['timings']['session.load']['count'] == 1
+
+def test_key_rotation():
+	app = TestApp(application())
+
+	## forge a session cookie signed before the key ring ##
+	SID = 'hjsdf7823jkdf'
+	c = SignedCookie(SECRET_KEY + SID)
+	c['SID'] = SID
+	c['user'] = 'foo'
+	c['atime'] = timegm( gmtime() )
+	s = 'Cookie: '+ '; '.join( m.output()[12:] for m in c.values() )
+
+	session.KEY_RING = KeyRing({'1': 'new secret'}, current='1', legacy=SECRET_KEY)
+	try:
+		response = app.get('/touch', extra_environ={'HTTP_COOKIE': s})
+	finally:
+		session.KEY_RING = None
+
+	res = str(response)
+	assert re.search('SID="%s.*\.1"' % SID, res)
+	assert re.search('atime=".*\.1"', res)
+
+def test_revocation():
+	app = TestApp(application())
+
+	## forge a session cookie, then revoke its SID ##
+	SID = 'sdf87dsfkj3h.%x' % int(time())
+	c = SignedCookie(SECRET_KEY + SID)
+	c['SID'] = SID
+	c['user'] = 'foo'
+	c['atime'] = timegm( gmtime() )
+	s = 'Cookie: '+ '; '.join( m.output()[12:] for m in c.values() )
+
+	session.REVOCATIONS = RevocationList()
+	try:
+		response = app.get('/touch', extra_environ={'HTTP_COOKIE': s})
+		assert 'Set-Cookie' not in str(response)
+
+		session.REVOCATIONS.revoke_session(SID)
+		response = app.get('/touch', extra_environ={'HTTP_COOKIE': s})
+	finally:
+		session.REVOCATIONS = None
+
+	res = str(response)
+	assert re.search('SID=.*Max-Age=0', res)
+	assert re.search('user="foo.*Max-Age=0', res)
+
+def test_revoke_user():
+	revocations = RevocationList()
+	now = time()
+	revocations.revoke_user('foo', now)
+
+	assert revocations.is_revoked('abc', 'foo', now - 10)
+	assert revocations.is_revoked('abc', 'foo')
+	assert not revocations.is_revoked('abc', 'foo', now + 10)
+	assert not revocations.is_revoked('abc', 'bar', now - 10)
+
+def test_revocation_sync():
+	writer, reader = RevocationList(), RevocationList()
+	reader.sync(force=True)
+	before = len(reader.sids)
+
+	## only the revocations stored since are added, each once ##
+	writer.revoke_session('sync-sid')
+	writer.revoke_user('sync-user', time() + 10)
+	reader.sync(force=True)
+	reader.sync(force=True)
+	assert reader.is_revoked('sync-sid')
+	assert reader.is_revoked('abc', 'sync-user', time())
+	assert len(reader.sids) == before + 1
+
+def test_revocation_load():
+	writer = RevocationList()
+	for sid in ('load-1', 'load-2', 'load-3'):
+		writer.revoke_session(sid)
+
+	## loaded one batch per check, with gets meanwhile ##
+	reader = RevocationList(batch_size=1)
+	assert reader.is_revoked('load-1')
+	assert reader.sids is None
+	assert not reader.is_revoked('load-4')
+	while reader.building is not None:
+		reader.sync()
+	assert 'load-3' in reader.sids
+	assert reader.is_revoked('load-2')
+
+def test_user_cache_copies():
+	store = SQLiteUserStore()
+	store.put_user(StoredUser('foo', 'foo@example.org', '', False))
+	saved, users.USER_STORE = users.USER_STORE, store
+	try:
+		users.uncache_user('foo')
+		user = users.get_user('foo')
+		user.suspended = True
+		assert not users.get_user('foo').suspended
+
+		users.put_user(user)
+		assert users.get_user('foo').suspended
+	finally:
+		users.uncache_user('foo')
+		users.USER_STORE = saved
+
+def test_sweep_signups():
+	store = SQLiteUserStore()
+	store.create_signup('foo', 'foo@example.org', 'secret')
+	store.create_signup('bar', 'bar@example.org', 'secret')
+	saved, users.USER_STORE = users.USER_STORE, store
+	try:
+		assert users.get_user('foo').suspended
+		n, cursor = users.sweep_signups(-1, 1, None, True)
+		assert n == 1 and cursor
+		n, cursor = users.sweep_signups(-1, 1, cursor, True)
+		assert n == 1
+		assert users.sweep_signups(-1, 1, cursor, True) == (0, None)
+		assert users.get_user('foo') is None
+		assert users.get_user('bar') is None
+	finally:
+		users.USER_STORE = saved
+
+def test_login_throttle():
+	store = SQLiteUserStore()
+	store.put_user(StoredUser('foo', 'foo@example.org',
+		make_password('secret', cost=1000), False))
+	saved = users.USER_STORE, auth_handlers.LOGIN_THROTTLE
+	users.USER_STORE = store
+	auth_handlers.LOGIN_THROTTLE = LoginThrottle(TokenBucket(0, 2), TokenBucket(0, 100))
+	app = TestApp(webapp.WSGIApplication([('/login', auth_handlers.Login)], debug=True))
+	attacker = {'REMOTE_ADDR': '10.0.0.66'}
+	try:
+		## a failure, then a success, which resets the count ##
+		response = app.post('/login', {'nickname': 'foo', 'password': 'guess'})
+		assert 'Incorrect nickname' in str(response)
+		response = app.post('/login', {'nickname': 'foo', 'password': 'secret'})
+		assert 'user="foo' in str(response)
+		response = app.post('/login', {'nickname': 'foo', 'password': 'guess'})
+		assert 'Incorrect nickname' in str(response)
+
+		## an attacker locks out the nickname from their own address only ##
+		for _ in range(2):
+			response = app.post('/login', {'nickname': 'foo', 'password': 'guess'},
+				extra_environ=attacker)
+		assert 'Incorrect nickname' in str(response)
+		response = app.post('/login', {'nickname': 'foo', 'password': 'secret'},
+			extra_environ=attacker)
+		assert 'Too many login attempts' in str(response)
+
+		response = app.post('/login', {'nickname': 'foo', 'password': 'secret'})
+		assert 'user="foo' in str(response)
+	finally:
+		users.USER_STORE, auth_handlers.LOGIN_THROTTLE = saved
+		users.uncache_user('foo')
+
+def test_nickname_index():
+	store = SQLiteUserStore()
+	for nickname in ('foo', 'bar', 'baz'):
+		store.put_user(StoredUser(nickname, nickname + '@example.org', '', False))
+	saved, users.USER_STORE = users.USER_STORE, store
+	try:
+		now = [0]
+		index = NicknameIndex(capacity=100, batch_size=2, clock=lambda: now[0])
+		assert not index.available('foo')	# scanning: from the store
+		assert index.current is None
+		assert index.available('qux')
+		assert index.current is not None
+		assert 'baz' in index.current
+
+		index.add('qux')
+		assert 'qux' in index.current
+		assert not index.available('bar')
+		assert index.available('quux')
+		assert index.building is None
+
+		## taken on another instance: picked up by the next scan ##
+		store.put_user(StoredUser('quuz', 'quuz@example.org', '', False))
+		now[0] += 600
+		index.available('foo')
+		assert index.building is not None and index.current is not None
+		while index.building is not None:
+			index.available('foo')
+		assert not index.available('quuz')
+		assert 'quuz' in index.current
+	finally:
+		users.USER_STORE = saved
+
+class Whoami(RequestHandler):
+	def get(self):
+		self.response.out.write('user: %s' % self.session.get('user'))
+
+class AcmeLogin(Login):
+	session_config = SessionConfig(SECRET_KEY, tenant='acme')
+
+class AcmeWhoami(Whoami):
+	session_config = AcmeLogin.session_config
+
+def test_session_config():
+	wsgi_app = webapp.WSGIApplication(
+			[	('/acme/login', AcmeLogin),
+				('/acme/whoami', AcmeWhoami),
+				('/whoami', Whoami)	],
+			debug=True)
+
+	## the handlers' config wins over the middleware's ##
+	for app in (TestApp(wsgi_app), TestApp(SessionMiddleware(wsgi_app))):
+		response = app.post( '/acme/login', {'nickname': 'foo'} )
+		s = 'Cookie: ' + '; '.join( re.findall('Set-Cookie: ([^;\r\n]*)', str(response)) )
+
+		response = app.get('/acme/whoami', extra_environ={'HTTP_COOKIE': s})
+		assert 'user: foo' in str(response)
+
+		## the tenant's cookies do not verify with the default config ##
+		response = app.get('/whoami', extra_environ={'HTTP_COOKIE': s})
+		assert 'user: None' in str(response)
+
+def test_middleware_session_class():
+	app = TestApp(SessionMiddleware(webapp.WSGIApplication(
+		[('/login', EnvelopeLogin)], debug=True)))
+
+	response = app.post( '/login', {'nickname': 'foo'} )
+
+	res = str(response)
+	assert res.count('Set-Cookie:') == 1
+	assert res.count(ENVELOPE_COOKIE + '=') == 1
+
+def plain_app(environ, start_response):
+	session = get_session(environ)
+	session['flash_msg'] = 'from WSGI'
+	session.flush()		# no response: left to the middleware
+	start_response('200 OK', [('Content-Type', 'text/plain')])
+	return [session['SID']]
+
+def test_middleware():
+	app = TestApp(SessionMiddleware(plain_app))
+
+	response = app.get('/')
+
+	res = str(response)
+	assert 'flash_msg="from WSGI' in res
+	assert res.count('Set-Cookie:') == 1
+
+def test_middleware_webapp():
+	app = TestApp(SessionMiddleware(application()))
+
+	response = app.post( '/loginflash', {'nickname': 'foo'} )
+
+	res = str(response)
+	assert res.count('Set-Cookie:') == 4
+	assert 'user="foo' in res
+
+class AsyncGreet(RequestHandler):
+	steps = []
+
+	@login_required_async
+	def get(self):
+		self.steps.append('started')
+		user = yield
+		self.steps.append('greeted')
+		self.response.out.write('Hello, ' + user.nickname)
+
+def test_login_required_async():
+	app = TestApp(SessionMiddleware(
+		webapp.WSGIApplication([('/greet', AsyncGreet)], debug=True),
+		loader_class=AsyncSessionLoader))
+
+	response = app.get('/greet')
+
+	assert response.status.startswith('302')
+	assert '/login?redirect=' in response.headers['Location']
+	assert AsyncGreet.steps == ['started']
+
+def test_authenticate_async():
+	store = SQLiteUserStore()
+	store.put_user(StoredUser('foo', 'foo@example.org',
+		make_password('secret', cost=1000), False))
+	saved, users.USER_STORE = users.USER_STORE, store
+	try:
+		login = authenticate_async('foo', 'secret')
+		assert login.get_result().nickname == 'foo'
+		assert authenticate_async('foo', 'guess').get_result() is None
+		assert authenticate_async('bar', 'secret').get_result() is None
+	finally:
+		users.USER_STORE = saved
+
+class PendingSession:
+	"""A session whose user has not been fetched yet."""
+	def __init__(self, nickname):
+		self._nickname = nickname
+		self.user = None
+
+def test_session_user_async():
+	store = SQLiteUserStore()
+	store.put_user(StoredUser('foo', 'foo@example.org', '', False))
+	saved, users.USER_STORE = users.USER_STORE, store
+	try:
+		session = PendingSession('foo')
+		future = session_user_async(session)
+		assert future.get_result().nickname == 'foo'
+		assert session.user.nickname == 'foo'
+
+		assert session_user_async(PendingSession(None)).get_result() is None
+	finally:
+		users.USER_STORE = saved
+		users.uncache_user('foo')
+
+def test_worker_pool_inline():
+	saved = os.environ.get('SERVER_SOFTWARE')
+	os.environ['SERVER_SOFTWARE'] = 'Development/1.0'
+	try:
+		pool = WorkerPool(2)
+		future = pool.submit(sum, [1, 2, 3])
+		assert not pool.workers
+		assert future.done() and future.get_result() == 6
+	finally:
+		if saved is None:
+			del os.environ['SERVER_SOFTWARE']
+		else:
+			os.environ['SERVER_SOFTWARE'] = saved
@@ -0,0 +1,142 @@
+#/usr/bin/env python2.5
+#-----------------------
+
+"""
+In-memory token-bucket throttling, used to limit login attempts
+per nickname from each client address, and per client address, before
+any Datastore or password hashing work is done.
+
+Buckets live in a bounded LRU cache, so memory is fixed no matter how
+many distinct keys are seen; an evicted bucket simply starts full
+again.  Limits are per instance.
+
+>>> t = TokenBucket(rate=0, burst=2)
+>>> t.allow('foo'), t.allow('foo'), t.allow('foo'), t.allow('bar')
+(True, True, False, True)
+>>> t.rejected
+1
+"""
+
+from threading import Lock
+from time import time
+
+from lru import LRUCache
+
+NICKNAME_BURST = 5
+NICKNAME_RATE = 1.0 / 60
+# login attempts per nickname from one client address: a burst of 5,
+# then one a minute.
+
+ADDRESS_BURST = 30
+ADDRESS_RATE = 1.0 / 6
+# login attempts per client address: a burst of 30, then ten a minute.
+
+MAX_BUCKETS = 10000
+# the number of buckets kept per TokenBucket.
+
+
+class TokenBucket(object):
+	"""
+	Allow up to burst events per key at once, refilled at rate per
+	second.
+
+	Attributes:
+		allowed		the number of events let through
+		rejected	the number of events refused
+	"""
+	def __init__(self, rate, burst, maxsize=MAX_BUCKETS, clock=time):
+		self.rate = rate
+		self.burst = burst
+		self.clock = clock
+		self.buckets = LRUCache(maxsize)	# key -> [tokens, last update]
+		self.lock = Lock()
+		self.allowed = self.rejected = 0
+
+	def tokens(self, key, now):
+		bucket = self.buckets.get(key)
+		if bucket is None:
+			return self.burst
+		tokens, last = bucket
+		return min(self.burst, tokens + (now - last) * self.rate)
+
+	def consume(self, key, tokens, now):
+		self.buckets[key] = [tokens - 1, now]
+
+	def allow(self, key):
+		"""Consume a token for key; return False if there was none."""
+		now = self.clock()
+		self.lock.acquire()
+		try:
+			tokens = self.tokens(key, now)
+			if tokens < 1:
+				self.rejected += 1
+				return False
+			self.consume(key, tokens, now)
+			self.allowed += 1
+			return True
+		finally:
+			self.lock.release()
+
+
+class LoginThrottle(object):
+	"""
+	Throttle login attempts by nickname from each client address, and
+	by client address.  An attempt is allowed only if both have a token
+	left, and only then are tokens consumed.
+
+	The nickname limit is per address, so that failed attempts from one
+	address cannot lock the user out everywhere; the address limit
+	bounds guessing over many nicknames.  reset() refills the bucket of
+	a nickname and address after a successful login.
+
+	>>> t = LoginThrottle(TokenBucket(0, 1), TokenBucket(0, 10))
+	>>> t.allow('foo', '10.0.0.1'), t.allow('foo', '10.0.0.1'), t.allow('foo', '10.0.0.2')
+	(True, False, True)
+	>>> t.reset('foo', '10.0.0.1'); t.allow('foo', '10.0.0.1')
+	True
+	"""
+	def __init__(self, nickname_bucket=None, address_bucket=None):
+		self.nicknames = nickname_bucket or \
+			TokenBucket(NICKNAME_RATE, NICKNAME_BURST)
+		self.addresses = address_bucket or \
+			TokenBucket(ADDRESS_RATE, ADDRESS_BURST)
+		self.lock = Lock()
+
+	def allow(self, nickname, address):
+		now = self.nicknames.clock()
+		key = (nickname, address)
+		self.lock.acquire()
+		try:
+			n_tokens = self.nicknames.tokens(key, now)
+			a_tokens = self.addresses.tokens(address, now)
+			if n_tokens < 1 or a_tokens < 1:
+				if n_tokens < 1:
+					self.nicknames.rejected += 1
+				if a_tokens < 1:
+					self.addresses.rejected += 1
+				return False
+			self.nicknames.consume(key, n_tokens, now)
+			self.addresses.consume(address, a_tokens, now)
+			self.nicknames.allowed += 1
+			self.addresses.allowed += 1
+			return True
+		finally:
+			self.lock.release()
+
+	def reset(self, nickname, address):
+		"""Forget the failed attempts of a nickname from an address."""
+		self.lock.acquire()
+		try:
+			self.nicknames.buckets.invalidate((nickname, address))
+		finally:
+			self.lock.release()
+
+	def stats(self):
+		"""Return a dictionary of the throttle counters."""
+		return {
+			'nickname_allowed': self.nicknames.allowed,
+			'nickname_rejected': self.nicknames.rejected,
+			'address_allowed': self.addresses.allowed,
+			'address_rejected': self.addresses.rejected,
+			'buckets': len(self.nicknames.buckets) + len(self.addresses.buckets),
+		}
@@ -0,0 +1,214 @@
+#/usr/bin/env python2.5
+#----------------------------
+# Datastore models for user & signup, and the user store keeping them
+# (see userstore.py).  users.py imports this module only when the
+# Datastore store is in use.
+#----------------------------
+
+from datetime import date, timedelta
+from hashlib import md5
+from time import time
+
+from google.appengine.ext import db
+
+import users
+from passwords import make_password, check_password
+
+
+class User(db.Model):
+	nickname = db.StringProperty(required=True)
+	email = db.EmailProperty(required=True)
+	pwd = db.StringProperty(required=True)
+	suspended = db.BooleanProperty(default=True)
+	
+	@classmethod
+	def authenticate(klass, nickname, password):
+		"""Return the user if password is correct; see users.authenticate."""
+		return users.authenticate(nickname, password)
+	
+	def __eq__(self, other):
+		return self.nickname == other.nickname
+	
+	def __copy__(self):
+		# a copy whose changes do not affect this entity
+		return db.model_from_protobuf(db.model_to_protobuf(self))
+
+
+def signup_id(nickname):
+	return md5( nickname + repr(time()) ).hexdigest()
+
+
+class UserSignup(db.Model):
+	user = db.ReferenceProperty(User, required=True)
+	date = db.DateProperty(auto_now_add=True)
+
+
+def signup_key(id):
+	"""
+	Return the key of the UserSignup with the id from a confirmation
+	link, which is either its encoded key or, for older links, its key
+	name.  Return None if id cannot be a signup id.
+	"""
+	try:
+		key = db.Key(id)
+	except (db.BadKeyError, db.BadArgumentError):
+		try:
+			return db.Key.from_path(UserSignup.kind(), id)
+		except db.BadArgumentError:
+			return None
+	if key.kind() != UserSignup.kind():
+		return None
+	return key
+
+
+def signup_user_key(signup_key):
+	"""Return the key of the User a signup was created for."""
+	if signup_key.parent() is not None:
+		return signup_key.parent()
+	signup = db.get(signup_key)
+	if signup is None:
+		return None
+	return UserSignup.user.get_value_for_datastore(signup)
+
+def has_legacy_signup(user_key, cutoff):
+	"""Return True if a user has a signup newer than cutoff outside its group."""
+	query = UserSignup.all(keys_only=True).filter('user =', user_key)
+	query.filter('date >=', cutoff)
+	return query.get() is not None
+
+def delete_suspended_user(user_key, cutoff):
+	"""
+	Delete a user if it is still suspended and has no signup newer than
+	cutoff in its entity group, checking both in a transaction on that
+	group, so that a user who confirms meanwhile is kept.  Return True
+	if the user was deleted.
+	"""
+	def txn():
+		user = db.get(user_key)
+		if user is None or not user.suspended:
+			return False
+		query = UserSignup.all(keys_only=True).filter('date >=', cutoff)
+		query.ancestor(user_key)
+		if query.get() is not None:
+			return False
+		db.delete(user_key)
+		return True
+	return db.run_in_transaction(txn)
+
+
+class DatastoreUserStore(object):
+	"""The user store of the User and UserSignup models."""
+	def get_user(self, nickname):
+		return User.get_by_key_name(nickname)
+
+	def get_user_rpc(self, nickname):
+		"""Return a db.get_async RPC of the user, or None without get_async."""
+		if hasattr(db, 'get_async'):
+			return db.get_async( db.Key.from_path(User.kind(), nickname) )
+
+	def get_user_by_email(self, email):
+		return User.all().filter('email =', email).get()
+
+	def put_user(self, user):
+		user.put()
+
+	def create_signup(self, nickname, email, password):
+		"""
+		Create a suspended User and its UserSignup in one transaction.
+
+		A suspended user signing up again with the same password gets
+		a new signup.  The signup is a child of the user, so that both
+		are in the same entity group; its id is its encoded key.
+		"""
+		pwd = make_password(password)
+		def txn():
+			user = User.get_by_key_name(nickname)
+			if user is None:
+				user = User(key_name=nickname, nickname=nickname,
+					email=email, pwd=pwd)
+				entities = [user]
+			elif user.suspended and check_password(password, user.pwd):
+				entities = []
+			else:
+				return None
+			signup = UserSignup(parent=user, key_name=signup_id(nickname), user=user)
+			db.put(entities + [signup])
+			return str(signup.key())
+		return db.run_in_transaction(txn)
+
+	def confirm_signup(self, id):
+		"""
+		Unsuspend the user and delete the signup in one transaction.
+
+		Signups created before create_signup are not in their user's
+		entity group.  They are confirmed in a cross-group transaction
+		where the SDK supports them, and otherwise with sequential,
+		non-transactional calls, which are safe to repeat.
+		"""
+		key = signup_key(id)
+		if key is None:
+			return None
+		user_key = key.parent()
+		if user_key is None:
+			def legacy_txn():
+				signup = db.get(key)
+				if signup is None:
+					return None
+				user = db.get(UserSignup.user.get_value_for_datastore(signup))
+				if user is not None:
+					user.suspended = False
+					db.put(user)
+				db.delete(key)
+				return user
+			if hasattr(db, 'create_transaction_options'):
+				return db.run_in_transaction_options(
+					db.create_transaction_options(xg=True), legacy_txn)
+			return legacy_txn()
+		def txn():
+			signup, user = db.get([key, user_key])
+			if signup is None or user is None:
+				return None
+			user.suspended = False
+			db.put(user)
+			db.delete(signup)
+			return user
+		return db.run_in_transaction(txn)
+
+	def signup_owner(self, id):
+		key = signup_key(id)
+		if key is not None and key.parent() is not None:
+			return User.get(key.parent())
+
+	def nicknames(self, cursor, limit):
+		query = User.all(keys_only=True)
+		if cursor:
+			query.with_cursor(cursor)
+		names = [key.name() for key in query.fetch(limit)]
+		if len(names) < limit:
+			return names, None
+		return names, query.cursor()
+
+	def sweep_signups(self, max_age=7, batch_size=100, cursor=None,
+			delete_users=False):
+		"""
+		Deleting is idempotent: a batch that is swept twice, e.g. after
+		a task retry, deletes nothing the second time.  The signups are
+		deleted after their users, so that if deleting a user fails the
+		retried batch still finds it.
+		"""
+		cutoff = date.today() - timedelta(days=max_age)
+		query = UserSignup.all(keys_only=True).filter('date <', cutoff).order('date')
+		if cursor:
+			query.with_cursor(cursor)
+		keys = query.fetch(batch_size)
+		if not keys:
+			return 0, None, []
+		user_keys = []
+		if delete_users:
+			user_keys = set(filter(None, [signup_user_key(k) for k in keys]))
+		deleted = [k.name() for k in user_keys
+			if not has_legacy_signup(k, cutoff) and delete_suspended_user(k, cutoff)]
+		db.delete(keys)
+		if len(keys) < batch_size:
+			return len(keys), None, deleted
+		return len(keys), query.cursor(), deleted
@@ -1,51 +1,142 @@
 #/usr/bin/env python2.5
 #----------------------------
-# Datastore models for user & signup
+# The functions of the auth stack, which work on any user store (see
+# userstore.py), and need nothing from the SDK unless the store is the
+# Datastore (see usermodels.py).
 #----------------------------
 
-from base64 import b64encode as b64
-from hashlib import md5, sha256
-from random import randint
-from time import time
+from copy import copy
 
-from google.appengine.ext import db
+from lru import LRUCache
+from metrics import METRICS
+from passwords import make_password, check_password, needs_rehash
 
 
-N_SALT = 8             # length of the password salt
+USER_CACHE_SIZE = 4096
+# the maximum number of User entities kept in memory per instance.
 
+USER_CACHE_TTL = 300   # 300s = 5m
+# how long a cached User may be served before it is fetched again.
+# The functions below which write users invalidate the local copy,
+# but other instances keep theirs until it expires.
 
-def salt_n_hash(password, salt=None):
+USER_CACHE = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+# nickname -> User; see USER_CACHE.stats() for hit/miss counters.
+# Callers get copies (see get_user), never the cached instances.
+
+
+
+USER_STORE = None
+# where users and signups are kept: a usermodels.DatastoreUserStore,
+# created on first use, unless set first; e.g. for a local database,
+#	USER_STORE = userstore.SQLiteUserStore('users.db')
+
+def user_store():
+	"""Return USER_STORE, creating the Datastore store if it is unset."""
+	global USER_STORE
+	if USER_STORE is None:
+		from usermodels import DatastoreUserStore
+		USER_STORE = DatastoreUserStore()
+	return USER_STORE
+
+
+def copy_user(user):
+	"""Return a copy of a user, which can be changed without affecting it."""
+	return copy(user)
+
+def cached_user(nickname):
+	"""Return a copy of the user with this nickname in USER_CACHE, or None."""
+	user = USER_CACHE.get(nickname)
+	if user is not None:
+		return copy_user(user)
+
+def cache_user(user):
+	"""Keep a user just fetched in USER_CACHE, and return a copy of it."""
+	USER_CACHE[user.nickname] = user
+	return copy_user(user)
+
+def uncache_user(nickname):
+	"""
+	Drop the cached user with this nickname.  The functions below call
+	it after each write; code writing users by other means must too.
+	"""
+	USER_CACHE.invalidate(nickname)
+
+def get_user(nickname):
 	"""
-	Generate a salt and return in base64 encoding the hash of the
-	password with the salt and the character '$' prepended to it.
+	Return a copy of the user with this nickname, from USER_CACHE if
+	possible, or None.  Changing it does not change the cached user;
+	write it back with put_user.
 	"""
-	salt = salt or b64( ''.join(chr(randint(0, 0xff)) for _ in range(N_SALT)) )
-	return salt + '$' + b64( sha256(salt+password.encode("ascii")).digest() )
+	user = cached_user(nickname)
+	if user is None:
+		user = user_store().get_user(nickname)
+		if user is not None:
+			user = cache_user(user)
+	return user
 
+def put_user(user):
+	user_store().put_user(user)
+	uncache_user(user.nickname)
 
-class User(db.Model):
-	nickname = db.StringProperty(required=True)
-	email = db.EmailProperty(required=True)
-	pwd = db.StringProperty(required=True)
-	suspended = db.BooleanProperty(default=True)
-	
-	@classmethod
-	def authenticate(klass, nickname, password):
-		"""Return an User() entity instance if password is correct"""
-		user = klass.get_by_key_name(nickname)
-		if user:
-			n_salt = user.pwd.index('$')
-			if user.pwd == salt_n_hash(password, salt=user.pwd[:n_salt]):
-				return user
-	
-	def __eq__(self, other):
-		return self.nickname == other.nickname
+def verify_password(user, password):
+	"""
+	Return True if password is the user's, upgrading the stored hash
+	if it is weaker than the current one.
+	"""
+	if not check_password(password, user.pwd):
+		return False
+	if needs_rehash(user.pwd):
+		user.pwd = make_password(password)
+		put_user(user)
+	return True
 
+def authenticate(nickname, password):
+	"""Return the user if password is correct, or None."""
+	t = METRICS.start()
+	try:
+		user = user_store().get_user(nickname)
+		if user and verify_password(user, password):
+			return user
+	finally:
+		METRICS.stop('users.authenticate', t)
 
-def signup_id(nickname):
-	return md5( nickname + repr(time()) ).hexdigest()
+def create_signup(nickname, email, password):
+	"""
+	Create a suspended user and its signup, and return the signup id
+	for the confirmation link, or None if the nickname is taken.
+	"""
+	id = user_store().create_signup(nickname, email, password)
+	if id is not None:
+		uncache_user(nickname)
+	return id
 
+def confirm_signup(id):
+	"""
+	Unsuspend the user of the signup with this id and return it, or
+	None if there is no such signup, e.g. because the link was
+	already followed.
+	"""
+	user = user_store().confirm_signup(id)
+	if user is not None:
+		uncache_user(user.nickname)
+	return user
+
+def signup_owner(id):
+	"""Return the user a signup was created for, even if confirmed."""
+	return user_store().signup_owner(id)
 
-class UserSignup(db.Model):
-	user = db.ReferenceProperty(User, required=True)
-	date = db.DateProperty(auto_now_add=True)
+def sweep_signups(max_age=7, batch_size=100, cursor=None, delete_users=False):
+	"""
+	Delete a batch of signups older than max_age days, and if
+	delete_users, the users they refer to which are still suspended
+	and have no more recent signup.
+
+	Return the number of signups deleted and the cursor of the next
+	batch, or None if there are no more.
+	"""
+	n, cursor, deleted = user_store().sweep_signups(max_age, batch_size,
+		cursor, delete_users)
+	for nickname in deleted:
+		uncache_user(nickname)
+	return n, cursor
@@ -0,0 +1,227 @@
+#/usr/bin/env python2.5
+#-----------------------
+
+"""
+Storage of users and signups behind one interface, so that the auth
+stack is not tied to the Datastore.  users.USER_STORE is the store in
+use: a usermodels.DatastoreUserStore by default, or a SQLiteUserStore,
+which needs nothing from the SDK.
+
+A user store implements:
+
+	get_user(nickname)			the user, or None
+	get_user_by_email(email)	a user with this email, or None
+	put_user(user)
+	create_signup(nickname, email, password)
+		create a suspended user and its signup; return the signup id,
+		or None if the nickname is taken
+	confirm_signup(id)		unsuspend the user of the signup and
+		return it, or None if there is no such unconfirmed signup
+	signup_owner(id)		the user the signup was created for, or None
+	nicknames(cursor, limit)
+		return a list of up to limit nicknames, and the cursor of the
+		next ones or None if there are no more; cursor is None at first
+	sweep_signups(max_age, batch_size, cursor, delete_users)
+		delete up to batch_size signups older than max_age days, and
+		if delete_users, their users which are still suspended and
+		have no more recent signup; return the number of signups
+		deleted, the cursor of the next batch or None, and the
+		nicknames of the users deleted
+
+and optionally, for stores with asynchronous calls:
+
+	get_user_rpc(nickname)
+		an RPC of get_user(nickname), whose get_result() waits for it,
+		or None
+
+Users have the attributes nickname, email, pwd and suspended.  Use the
+functions of users.py rather than the store, as they keep USER_CACHE
+up to date.
+
+>>> store = SQLiteUserStore()
+>>> id = store.create_signup('foo', 'foo@x.org', 'secret')
+>>> store.create_signup('foo', 'foo@x.org', 'other') is None
+True
+>>> store.get_user('foo').suspended
+True
+>>> store.confirm_signup(id).suspended, store.confirm_signup(id)
+(False, None)
+>>> store.signup_owner(id).nickname
+'foo'
+"""
+
+import sqlite3
+from os import urandom
+from threading import Lock
+from datetime import date, timedelta
+
+from passwords import make_password, check_password
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+	nickname TEXT PRIMARY KEY,
+	email TEXT NOT NULL,
+	pwd TEXT NOT NULL,
+	suspended INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS users_email ON users (email);
+CREATE TABLE IF NOT EXISTS signups (
+	id TEXT PRIMARY KEY,
+	nickname TEXT NOT NULL REFERENCES users (nickname),
+	date TEXT NOT NULL,
+	confirmed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS signups_nickname ON signups (nickname);
+CREATE INDEX IF NOT EXISTS signups_date ON signups (date);
+"""
+
+# The statements are constants, so that sqlite3 prepares each of them
+# once per connection and reuses it from its statement cache.
+SELECT_USER = 'SELECT nickname, email, pwd, suspended FROM users WHERE nickname = ?'
+SELECT_NICKNAMES = 'SELECT nickname FROM users WHERE nickname > ? ORDER BY nickname LIMIT ?'
+SELECT_USER_BY_EMAIL = 'SELECT nickname, email, pwd, suspended FROM users WHERE email = ? LIMIT 1'
+INSERT_USER = 'INSERT INTO users (nickname, email, pwd, suspended) VALUES (?, ?, ?, ?)'
+UPDATE_USER = 'UPDATE users SET email = ?, pwd = ?, suspended = ? WHERE nickname = ?'
+UNSUSPEND_USER = 'UPDATE users SET suspended = 0 WHERE nickname = ?'
+INSERT_SIGNUP = 'INSERT INTO signups (id, nickname, date) VALUES (?, ?, ?)'
+SELECT_SIGNUP = 'SELECT nickname, confirmed FROM signups WHERE id = ?'
+CONFIRM_SIGNUP = 'UPDATE signups SET confirmed = 1 WHERE id = ?'
+SELECT_STALE_SIGNUPS = 'SELECT id, nickname, date FROM signups WHERE date >= ? AND date < ? ORDER BY date LIMIT ?'
+DELETE_SIGNUP = 'DELETE FROM signups WHERE id = ?'
+DELETE_SUSPENDED_USER = """DELETE FROM users WHERE nickname = ? AND suspended = 1
+	AND NOT EXISTS (SELECT 1 FROM signups WHERE nickname = ? AND date >= ?)"""
+
+
+class StoredUser(object):
+	"""A user of a SQLiteUserStore."""
+	def __init__(self, nickname, email, pwd, suspended=True):
+		self.nickname = nickname
+		self.email = email
+		self.pwd = pwd
+		self.suspended = bool(suspended)
+
+	def __eq__(self, other):
+		return self.nickname == other.nickname
+
+	def __repr__(self):
+		return '<StoredUser %s>' % self.nickname
+
+
+class SQLiteUserStore(object):
+	"""
+	Users and signups in a SQLite database at path, ':memory:' by
+	default.  The store keeps a single connection, shared by all
+	threads and serialized by a lock; signups are created and
+	confirmed in IMMEDIATE transactions, so that several processes
+	can share the file.
+
+	Confirmed signups are kept, so that signup_owner() still finds
+	them, until sweep_signups() deletes them.
+	"""
+	def __init__(self, path=':memory:'):
+		self.path = path
+		self.lock = Lock()
+		self.db = sqlite3.connect(path, check_same_thread=False,
+			isolation_level=None)
+		self.db.text_factory = str
+		self.db.executescript(SCHEMA)
+
+	def query(self, sql, *args):
+		self.lock.acquire()
+		try:
+			return self.db.execute(sql, args).fetchall()
+		finally:
+			self.lock.release()
+
+	def transaction(self, func, *args):
+		"""Return func(cursor, *args), run in one transaction."""
+		self.lock.acquire()
+		try:
+			cursor = self.db.cursor()
+			cursor.execute('BEGIN IMMEDIATE')
+			try:
+				result = func(cursor, *args)
+			except:
+				cursor.execute('ROLLBACK')
+				raise
+			cursor.execute('COMMIT')
+			return result
+		finally:
+			self.lock.release()
+
+	def get_user(self, nickname):
+		rows = self.query(SELECT_USER, nickname)
+		if rows:
+			return StoredUser(*rows[0])
+
+	def get_user_by_email(self, email):
+		rows = self.query(SELECT_USER_BY_EMAIL, email)
+		if rows:
+			return StoredUser(*rows[0])
+
+	def put_user(self, user):
+		def txn(cursor):
+			cursor.execute(UPDATE_USER, (user.email, user.pwd,
+				int(user.suspended), user.nickname))
+			if cursor.rowcount == 0:
+				cursor.execute(INSERT_USER, (user.nickname, user.email,
+					user.pwd, int(user.suspended)))
+		self.transaction(txn)
+
+	def create_signup(self, nickname, email, password):
+		pwd = make_password(password)
+		id = urandom(16).encode('hex')
+		def txn(cursor):
+			row = cursor.execute(SELECT_USER, (nickname,)).fetchone()
+			if row is None:
+				cursor.execute(INSERT_USER, (nickname, email, pwd, 1))
+			elif not (row[3] and check_password(password, row[2])):
+				return None
+			cursor.execute(INSERT_SIGNUP, (id, nickname, date.today().isoformat()))
+			return id
+		return self.transaction(txn)
+
+	def confirm_signup(self, id):
+		def txn(cursor):
+			row = cursor.execute(SELECT_SIGNUP, (id,)).fetchone()
+			if row is None or row[1]:
+				return None
+			cursor.execute(CONFIRM_SIGNUP, (id,))
+			cursor.execute(UNSUSPEND_USER, (row[0],))
+			row = cursor.execute(SELECT_USER, (row[0],)).fetchone()
+			return row and StoredUser(*row)
+		return self.transaction(txn)
+
+	def signup_owner(self, id):
+		rows = self.query(SELECT_SIGNUP, id)
+		if rows:
+			return self.get_user(rows[0][0])
+
+	def nicknames(self, cursor, limit):
+		names = [row[0] for row in self.query(SELECT_NICKNAMES, cursor or '', limit)]
+		if len(names) < limit:
+			return names, None
+		return names, names[-1]
+
+	def sweep_signups(self, max_age=7, batch_size=100, cursor=None,
+			delete_users=False):
+		"""
+		The cursor is the date of the last signup deleted: the older
+		ones are all gone.
+		"""
+		cutoff = (date.today() - timedelta(days=max_age)).isoformat()
+		def txn(db_cursor):
+			rows = db_cursor.execute(SELECT_STALE_SIGNUPS,
+				(cursor or '', cutoff, batch_size)).fetchall()
+			for id, nickname, day in rows:
+				db_cursor.execute(DELETE_SIGNUP, (id,))
+			deleted = []
+			if delete_users:
+				for nickname in set(row[1] for row in rows):
+					db_cursor.execute(DELETE_SUSPENDED_USER, (nickname, nickname, cutoff))
+					if db_cursor.rowcount:
+						deleted.append(nickname)
+			if len(rows) < batch_size:
+				return len(rows), None, deleted
+			return len(rows), rows[-1][2], deleted
+		return self.transaction(txn)
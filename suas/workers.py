@@ -0,0 +1,108 @@
+#/usr/bin/env python2.5
+#-----------------------
+
+"""
+A fixed-size pool of worker threads, and the futures it returns.
+
+Futures follow the App Engine RPC convention: get_result() waits for
+the call and returns its value or raises its exception.
+
+App Engine does not let a request start threads, nor make API calls
+from a thread that outlives it, so there a pool starts no threads and
+runs each call on the caller's thread, in submit().
+
+>>> pool = WorkerPool(2)
+>>> pool.submit(sum, [1, 2, 3]).get_result()
+6
+>>> done(42).get_result()
+42
+>>> threads_allowed({'SERVER_SOFTWARE': 'Google App Engine/1.4.0'})
+False
+"""
+
+import os
+from threading import Thread, Event
+from Queue import Queue
+
+
+class Future(object):
+	"""The pending result of a call."""
+	def __init__(self):
+		self.event = Event()
+		self.value = self.error = None
+
+	def set_result(self, value):
+		self.value = value
+		self.event.set()
+
+	def set_exception(self, error):
+		self.error = error
+		self.event.set()
+
+	def done(self):
+		return self.event.isSet()
+
+	def get_result(self, timeout=None):
+		self.event.wait(timeout)
+		if not self.event.isSet():
+			raise RuntimeError("Timed out waiting for a result")
+		if self.error is not None:
+			raise self.error
+		return self.value
+
+	result = get_result
+
+
+def done(value):
+	"""Return a future already holding value."""
+	future = Future()
+	future.set_result(value)
+	return future
+
+
+def threads_allowed(environ=os.environ):
+	"""Return whether we may start threads: not on App Engine."""
+	return not environ.get('SERVER_SOFTWARE', '').startswith(
+		('Google App Engine', 'Development'))
+
+
+class WorkerPool(object):
+	"""
+	A fixed number of worker threads running submitted calls.
+
+	At most size calls run at once; up to backlog more wait in the
+	queue, after which submit() blocks.  Where threads_allowed() is
+	false there are no workers, and submit() runs the call itself.
+	"""
+	def __init__(self, size=2, backlog=64):
+		self.queue = Queue(backlog)
+		self.workers = []
+		if not threads_allowed():
+			size = 0
+		for _ in range(size):
+			t = Thread(target=self.work)
+			t.setDaemon(True)
+			t.start()
+			self.workers.append(t)
+
+	def work(self):
+		while True:
+			self.call( *self.queue.get() )
+
+	def call(self, future, func, args):
+		try:
+			future.set_result( func(*args) )
+		except Exception, e:
+			future.set_exception(e)
+
+	def submit(self, func, *args):
+		"""Return a Future of func(*args), run by a worker."""
+		future = Future()
+		if self.workers:
+			self.queue.put( (future, func, args) )
+		else:
+			self.call(future, func, args)
+		return future
+
+	def run(self, func, *args):
+		return self.submit(func, *args).get_result()